@@ -0,0 +1,187 @@
+"""
+Benchmarks for Urd's own overhead, against a local SQLite database.
+
+Run from the repository root:
+
+    python -m benchmarks.run --tasks 10,100,500 --output results.json
+
+Results are written as JSON, with all times in seconds.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+from contextlib import redirect_stdout
+from datetime import (
+    datetime,
+    timedelta,
+)
+from socket import gethostname
+from time import (
+    perf_counter,
+    sleep,
+    time,
+)
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db.models import Sum  # noqa: E402
+
+from urd.models import (  # noqa: E402
+    Log,
+    LogChunk,
+    Task,
+)
+from urd.monitor import Monitor  # noqa: E402
+from urd.worker import Logger  # noqa: E402
+
+
+def reset_database():
+    if os.path.exists(settings.DATABASES['default']['NAME']):
+        os.remove(settings.DATABASES['default']['NAME'])
+    call_command('migrate', verbosity=0)
+
+
+def create_tasks(count, **kwargs):
+    Task.objects.all().delete()
+    defaults = dict(
+        function='benchmarks.tasks.noop',
+        interval=timedelta(hours=1),
+        environment=settings.ENV,
+        next_execution_time=datetime.now() + timedelta(hours=1),
+    )
+    Task.objects.bulk_create([Task(name=f'task {i}', **{**defaults, **kwargs}) for i in range(count)])
+    return list(Task.objects.all())
+
+
+def timed(f, repeat):
+    start = perf_counter()
+    for _ in range(repeat):
+        f()
+    return (perf_counter() - start) / repeat
+
+
+def bench_monitor_tick(task_counts, repeat):
+    results = []
+    for count in task_counts:
+        tasks = create_tasks(count)
+        monitor = Monitor(settings.ENV)
+        with redirect_stdout(io.StringIO()):
+            monitor.tick()
+
+        def changed_tick():
+            Task.objects.filter(pk=tasks[0].pk).update(next_execution_time=datetime.now() + timedelta(hours=1))
+            monitor.tick()
+
+        results.append(dict(
+            tasks=count,
+            idle_tick=timed(monitor.tick, repeat),
+            changed_tick=timed(changed_tick, repeat),
+        ))
+    return results
+
+
+def bench_heartbeat(repeat):
+    task, = create_tasks(1, pid=os.getpid(), host=gethostname())
+    task.heartbeat()
+    return dict(
+        heartbeat_fast_path=timed(task.heartbeat, repeat),
+        check_lock=timed(task.check_lock, repeat),
+    )
+
+
+def bench_logger(lines):
+    task, = create_tasks(1)
+    with redirect_stdout(io.StringIO()):
+        start = perf_counter()
+        with Logger(task):
+            for i in range(lines):
+                print('benchmark output line', i)
+        duration = perf_counter() - start
+    assert LogChunk.objects.filter(log__task=task).aggregate(lines=Sum('line_count'))['lines'] == lines
+    return dict(
+        lines=lines,
+        seconds=duration,
+        lines_per_second=lines / duration,
+    )
+
+
+def bench_spawn_latency(samples, monitor_args):
+    # Time from when a slot is due until the task function is entered, via monitor -> manage.py worker -> worker()
+    interval = 1
+    first_due = time() + 2
+    task, = create_tasks(
+        1,
+        function='benchmarks.tasks.entry',
+        interval=timedelta(seconds=interval),
+        next_execution_time=datetime.fromtimestamp(first_due),
+    )
+    monitor = subprocess.Popen(
+        [sys.executable, 'manage.py', 'monitor', *monitor_args],
+        env=dict(os.environ, DJANGO_SETTINGS_MODULE='benchmarks.settings'),
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        sleep(first_due - time() + samples * interval + 0.5)
+    finally:
+        monitor.terminate()
+        monitor.wait()
+
+    # Each run is measured against the first slot it was due for. That is the slot it served (recorded as the log's lag, rounded to the slot grid), minus the slots it skipped, so a run that starts an interval or more late shows up as such.
+    lags = []
+    for log in Log.objects.filter(task=task, lag__isnull=False):
+        served = round((log.execution_time.timestamp() - log.lag.total_seconds() - first_due) / interval)
+        due = first_due + (served - log.missed_slots) * interval
+        lags.extend(float(x) - due for x in log.lines())
+    lags.sort()
+    return dict(
+        samples=len(lags),
+        min=lags[0] if lags else None,
+        median=lags[len(lags) // 2] if lags else None,
+        max=lags[-1] if lags else None,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', default='10,100,500', help='Comma separated list of task counts for the monitor tick benchmark')
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--lines', type=int, default=50000)
+    parser.add_argument('--spawn-samples', type=int, default=5, help='Number of executions to measure spawn latency over. 0 to skip.')
+    parser.add_argument('--fork-server', action='store_true', help='Run the monitor in fork server mode for the spawn latency benchmark')
+    parser.add_argument('--output', help='File to write the JSON results to. Defaults to stdout.')
+    args = parser.parse_args()
+
+    reset_database()
+
+    results = dict(
+        python=platform.python_version(),
+        django=django.get_version(),
+        monitor_tick=bench_monitor_tick([int(x) for x in args.tasks.split(',')], args.repeat),
+        heartbeat=bench_heartbeat(args.repeat),
+        logger=bench_logger(args.lines),
+    )
+    if args.spawn_samples:
+        results['spawn_latency'] = bench_spawn_latency(args.spawn_samples, ['--fork-server'] if args.fork_server else [])
+
+    Log.objects.all().delete()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+import os
+import tempfile
+
+from tests.settings import *  # noqa: F401,F403
+
+# Workers started by the monitor are separate processes, so the database has to be a file
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('URD_BENCHMARK_DB', os.path.join(tempfile.gettempdir(), 'urd_benchmark.sqlite')),
+    }
+}
+
+ENV = 'benchmark'
@@ -0,0 +1,9 @@
+from time import time
+
+
+def noop(heartbeat):
+    heartbeat()
+
+
+def entry(heartbeat):
+    print(repr(time()))
@@ -4,6 +4,9 @@ from django.urls import (
 )
 from iommi.admin import Admin
 
+from urd.views import tail
+
 urlpatterns = [
     path('admin/', include(Admin().urls())),
+    path('tail/<int:task_pk>/', tail),
 ]
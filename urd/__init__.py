@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from socket import gethostname
 from datetime import timedelta
 from importlib import import_module
 
@@ -6,17 +7,57 @@ from django.conf import settings
 
 __version__ = '1.3.2'
 
+CONTROLLED_HEARTBEAT_INTERVAL = timedelta(seconds=5)
+CRASH_BACKOFF = timedelta(seconds=1)
+CRASH_BACKOFF_MAX = timedelta(minutes=5)
+CRASH_LOOP_THRESHOLD = 3
+CRASH_LOOP_WINDOW = timedelta(minutes=1)
+EXIT_SWEEP_INTERVAL = 5
+HEARTBEAT_INTERVAL = timedelta(seconds=1)
 INTERVAL_WARNING_THRESHOLD = timedelta(seconds=5)
 KEEP_LOGS = 10
+LEASE_DURATION = timedelta(seconds=30)
+LEASE_RENEW_INTERVAL = 5
+LOG_BUFFER_AGE = 1
+LOG_BUFFER_LINES = 1000
+LOG_BUFFER_SIZE = 64 * 1024
+LOG_LINES_PER_RUN = 1000
+LOG_RUNS_PER_PAGE = 3
+LOG_SWEEP_BATCH_SIZE = 500
+LOG_SWEEP_INTERVAL = 60
+LOG_SWEEP_PAUSE = 1
+LOG_SWEEP_TASKS = 50
+METRICS_LAG_RUNS = 20
+MIN_HEARTBEAT_TIMEOUT = 2 * CONTROLLED_HEARTBEAT_INTERVAL
+MONITOR_POLL_INTERVAL = 0.1
+PRECISE_SCHEDULING_WINDOW = 1
+REAP_CHECK_INTERVAL = 1
+RETRY_BACKOFF = timedelta(seconds=1)
+RETRY_BACKOFF_MAX = timedelta(minutes=1)
+RETRY_CHECK_INTERVAL = 5
 SHUTDOWN_TIMEOUT = timedelta(seconds=10)
 SHUTDOWN_EXIT_CODE = 7
 SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE = 8
+SPAWN_LEAD_TIME = timedelta(seconds=10)
+STREAM_POLL_TIMEOUT = 0.1
+TAIL_CACHE_TIMEOUT = 1
+TAIL_MAX_WAITERS = 10
+TAIL_POLL_INTERVAL = 0.5
+TAIL_TIMEOUT = 20
+THREAD_WORKERS = 1
+WORKER_CHECK_INTERVAL = 5
+WORKER_KEEP_ALIVE = timedelta(minutes=5)
 
 
 class ShuttingDown(Exception):
     pass
 
 
+# The function of the task can't be found. The worker shuts down, but the run counts as an error.
+class FunctionNotFound(ShuttingDown):
+    pass
+
+
 @dataclass
 class Task:
     app_name: str
@@ -28,10 +69,15 @@ def get_env():
     return getattr(settings, 'ENV', 'unknown ENV')
 
 
+def get_node_name():
+    return getattr(settings, 'URD_NODE_NAME', None) or gethostname()
+
+
 def schedulable_task(*function, use_transaction=True):
     def decorator(f):
         f._is_task = True
         f._use_transaction = use_transaction
+        _function_by_path[f'{f.__module__}.{f.__name__}'] = f
         return f
 
     if function:
@@ -41,23 +87,57 @@ def schedulable_task(*function, use_transaction=True):
     return decorator
 
 
-def get_tasks():
+_function_by_path = {}
+_task_by_function = {}
+_autodiscovered = False
+
+
+def autodiscover_tasks():
+    # Called on first use rather than at startup, so a broken tasks module only breaks what needs the tasks. The registry is only kept if every module imported, so a failed discovery is tried again next time.
+    global _autodiscovered, _task_by_function
+    if _autodiscovered:
+        return
+
     from django.apps import apps
 
-    task_list = []
+    task_by_function = {}
+    function_by_path = {}
     for app_name, app in apps.app_configs.items():
+        task_module_name = f'{app.module.__name__}.tasks'
         try:
-            task_module_name = f'{app.module.__name__}.tasks'
-            for name, variable in import_module(task_module_name).__dict__.items():
-                if not name.startswith('_') and getattr(variable, '_is_task', False):
-                    task_list.append(
-                        Task(
-                            app_name=app_name,
-                            function=f'{task_module_name}.{name}',
-                            name=name.replace('_', ' ').capitalize(),
-                        )
-                    )
-        except ImportError:
-            pass
-
-    return task_list
+            task_module = import_module(task_module_name)
+        except ModuleNotFoundError as e:
+            if e.name != task_module_name:
+                raise
+            continue
+
+        for name, variable in task_module.__dict__.items():
+            if not name.startswith('_') and getattr(variable, '_is_task', False):
+                function = f'{task_module_name}.{name}'
+                function_by_path[function] = variable
+                task_by_function[function] = Task(
+                    app_name=app_name,
+                    function=function,
+                    name=name.replace('_', ' ').capitalize(),
+                )
+
+    _function_by_path.update(function_by_path)
+    _task_by_function = task_by_function
+    _autodiscovered = True
+
+
+def get_tasks():
+    autodiscover_tasks()
+    return list(_task_by_function.values())
+
+
+def get_task_function(function):
+    try:
+        return _function_by_path[function]
+    except KeyError:
+        pass
+
+    module_name, _, name = function.rpartition('.')
+    f = getattr(import_module(module_name), name)
+    _function_by_path[function] = f
+    return f
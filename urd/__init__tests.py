@@ -1,4 +1,11 @@
+from unittest import mock
+
+import pytest
+
+import tests.tasks
+import urd
 from urd import (
+    get_task_function,
     get_tasks,
     Task,
 )
@@ -7,3 +14,27 @@ from urd import (
 def test_get_tasks():
     for t in get_tasks():
         assert isinstance(t, Task)
+
+
+def test_get_tasks_is_cached():
+    assert 'tests.tasks.test_task' in [x.function for x in get_tasks()]
+    with mock.patch('urd.import_module') as import_module:
+        get_tasks()
+        assert get_task_function('tests.tasks.test_task') is tests.tasks.test_task
+    import_module.assert_not_called()
+
+
+def test_failed_discovery_is_not_cached():
+    real_import_module = urd.import_module
+
+    def broken_import_module(name):
+        if name == 'tests.tasks':
+            raise ImportError('broken dependency')
+        return real_import_module(name)
+
+    with mock.patch.object(urd, '_autodiscovered', False), mock.patch.object(urd, '_task_by_function', {}):
+        with mock.patch('urd.import_module', new=broken_import_module):
+            with pytest.raises(ImportError):
+                get_tasks()
+
+        assert 'tests.tasks.test_task' in [x.function for x in get_tasks()]
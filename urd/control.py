@@ -0,0 +1,111 @@
+import os
+from datetime import (
+    datetime,
+    timedelta,
+)
+from threading import (
+    Event,
+    Thread,
+)
+
+
+# Monitor side of the pipe to a worker
+class ControlChannel:
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        # Never let a stuck worker block the monitor
+        os.set_blocking(self.write_fd, False)
+
+    def send(self, command, *args):
+        try:
+            os.write(self.write_fd, ' '.join([command, *args]).encode() + b'\n')
+        except OSError:
+            # The worker is gone or not reading, and the database is the fallback anyway
+            pass
+
+    def shutdown(self):
+        self.send('shutdown')
+
+    def release(self):
+        self.send('release')
+
+    def interval(self, interval, next_execution_time):
+        self.send(
+            'interval',
+            str(interval // timedelta(microseconds=1)),
+            next_execution_time.isoformat() if next_execution_time is not None else '-',
+        )
+
+    def close_read_end(self):
+        if self.read_fd is not None:
+            os.close(self.read_fd)
+            self.read_fd = None
+
+    def close(self):
+        self.close_read_end()
+        os.close(self.write_fd)
+
+
+# A task running in a thread worker is addressed through the pipe of its worker process, see urd.worker.run_thread_worker
+class TaskChannel(ControlChannel):
+    def __init__(self, channel, task_pk):
+        self.channel = channel
+        self.task_pk = task_pk
+
+    def send(self, command, *args):
+        self.channel.send(command, str(self.task_pk), *args)
+
+    def close_read_end(self):
+        pass
+
+    def close(self):
+        # The pipe belongs to the thread worker
+        pass
+
+
+# Commands from the monitor are applied to the task from a background thread, so that heartbeat() only has to check a flag.
+class TaskControl:
+    def __init__(self, task):
+        self.task = task
+        self.shutdown = False
+        # Set when the monitor wants the worker slot for another task. The worker exits between runs.
+        self.release = False
+        self.wakeup = Event()
+        # Set when the monitor closes the pipe. Commands can't be pushed to us anymore, so the worker goes back to checking the database.
+        self.closed = False
+        # Called from the listener thread, see Task._execute_async
+        self.on_shutdown = None
+
+    def apply(self, command, args):
+        if command == 'shutdown':
+            self.shutdown = True
+            if self.on_shutdown is not None:
+                self.on_shutdown()
+        elif command == 'release':
+            self.release = True
+        elif command == 'interval':
+            interval, next_execution_time = args
+            self.task.interval = timedelta(microseconds=int(interval))
+            self.task.next_execution_time = datetime.fromisoformat(next_execution_time) if next_execution_time != '-' else None
+        self.wakeup.set()
+
+    def sleep(self, seconds):
+        # Like time.sleep, but returns early (and True) if a command arrives
+        woken = self.wakeup.wait(seconds)
+        self.wakeup.clear()
+        return woken
+
+
+# Worker side of the pipe
+class WorkerControl(TaskControl):
+    def __init__(self, task, fd):
+        super().__init__(task)
+        self.file = os.fdopen(fd, 'r')
+        Thread(target=self.listen, daemon=True).start()
+
+    def listen(self):
+        for line in self.file:
+            command, *args = line.split()
+            self.apply(command, args)
+        self.closed = True
+        self.wakeup.set()
@@ -0,0 +1,147 @@
+import asyncio
+import os
+from datetime import timedelta
+from socket import gethostname
+from threading import Timer
+from unittest import mock
+
+import pytest
+import time_machine
+from django.utils import timezone
+
+from urd import (
+    SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE,
+    ShuttingDown,
+)
+from urd.control import (
+    ControlChannel,
+    TaskControl,
+    WorkerControl,
+)
+from urd.models import Task
+from urd.monitor import Monitor
+from urd.worker import worker
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def test_interval_and_shutdown_are_pushed_to_the_worker():
+    task = Task.objects.create(name='a', function='a', interval=timedelta(seconds=1), pid=os.getpid(), host=gethostname())
+    channel = ControlChannel()
+    task.control = WorkerControl(task, channel.read_fd)
+    task.heartbeat()
+
+    next_execution_time = timezone.now() + timedelta(minutes=1)
+    channel.interval(timedelta(minutes=2), next_execution_time)
+    task.control.sleep(5)
+    assert task.interval == timedelta(minutes=2)
+    assert task.next_execution_time == next_execution_time
+
+    channel.shutdown()
+    task.control.sleep(5)
+    with pytest.raises(ShuttingDown) as e:
+        task.heartbeat()
+    assert str(e.value) == 'Got shutdown command'
+    assert Task.objects.get(pk=task.pk).pid is None
+
+    channel.close_read_end()
+    channel.close()
+
+
+def test_monitor_asks_workers_to_shut_down_before_terminating():
+    task = Task.objects.create(name='a', function='a', interval=timedelta(seconds=1), environment='test')
+    channel = mock.Mock()
+    process = mock.Mock(pid=123)
+    process.poll.return_value = None
+
+    monitor = Monitor('test')
+
+    def spawn(t):
+        monitor.channel_by_task[t] = channel
+        return process
+
+    with mock.patch.object(monitor, 'spawn', new=spawn):
+        monitor.tick()
+
+    Task.objects.filter(pk=task.pk).update(interval=timedelta(seconds=2))
+    monitor.tick()
+    channel.interval.assert_called_once_with(timedelta(seconds=2), None)
+
+    task.disable()
+    monitor.tick()
+    channel.shutdown.assert_called_once_with()
+    process.terminate.assert_not_called()
+
+    with mock.patch('urd.monitor.monotonic', return_value=float('inf')):
+        monitor.tick()
+    process.terminate.assert_called_once_with()
+
+    process.poll.return_value = 0
+    monitor.tick()
+    assert monitor.stopping == {}
+    channel.close.assert_called_once_with()
+
+
+async def function_to_run_async_forever(heartbeat):
+    await heartbeat()
+    await asyncio.sleep(30)
+
+
+def test_shutdown_cancels_async_task():
+    task = Task.objects.create(name='a', function='urd.control__tests.function_to_run_async_forever', interval=timedelta(seconds=1), pid=os.getpid(), host=gethostname())
+    channel = ControlChannel()
+    task.control = WorkerControl(task, channel.read_fd)
+
+    Timer(0.1, channel.shutdown).start()
+    with pytest.raises(ShuttingDown) as e:
+        task.execute()
+    assert str(e.value) == 'Got shutdown command'
+    assert Task.objects.get(pk=task.pk).pid is None
+
+    channel.close_read_end()
+    channel.close()
+
+
+def test_released_worker_exits_before_its_next_run():
+    task = Task.objects.create(name='a', function='a', interval=timedelta(seconds=1), next_execution_time=timezone.now() + timedelta(seconds=1))
+    task.control = TaskControl(task)
+    task.control.apply('release', [])
+    assert worker(task) == SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
+    assert not task.logs.exists()
+
+
+def function_to_do_nothing(heartbeat):
+    pass
+
+
+def test_worker_with_a_control_channel_sleeps_without_checking_the_database(settings):
+    settings.URD_WORKER_MAX_RUNS = 1
+    task = Task.objects.create(name='a', function='urd.control__tests.function_to_do_nothing', interval=timedelta(minutes=1), next_execution_time=timezone.now() + timedelta(seconds=12))
+    task.control = TaskControl(task)
+    with time_machine.travel(timezone.now().timestamp(), tick=False) as traveller:
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            traveller.shift(timedelta(seconds=seconds))
+            return False
+
+        with mock.patch.object(task.control, 'sleep', new=fake_sleep), \
+             mock.patch.object(Task, 'check_lock', autospec=True, side_effect=Task.check_lock) as check_lock:
+            assert worker(task) == SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
+
+    assert len(sleeps) == 1
+    assert sleeps[0] == pytest.approx(12, abs=0.1)
+    # Before the sleep and before the run
+    assert check_lock.call_count == 2
+    assert task.logs.count() == 1
+
+
+def test_worker_control_is_closed_when_the_monitor_goes_away():
+    task = Task.objects.create(name='a', function='a', interval=timedelta(seconds=1))
+    channel = ControlChannel()
+    task.control = WorkerControl(task, channel.read_fd)
+    os.close(channel.write_fd)
+    assert task.control.sleep(5)
+    assert task.control.closed
+    assert not task.control.shutdown
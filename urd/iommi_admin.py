@@ -1,13 +1,75 @@
 from gettext import gettext
+from itertools import islice
+
+from django.urls import (
+    NoReverseMatch,
+    reverse,
+)
+from django.utils.html import format_html
 
 from iommi import (
+    Action,
+    Column,
     Field,
     MenuItem,
     Table,
 )
+from iommi.struct import Struct
+
+from urd import (
+    get_tasks,
+    LOG_LINES_PER_RUN,
+    LOG_RUNS_PER_PAGE,
+)
+from urd.views import tail
+
+
+def _more_lines(task, count, newest):
+    text = gettext('{count} more lines').format(count=count)
+    if newest:
+        # The tail view shows the newest run, if it's in the urls
+        try:
+            return format_html('<a href="{}">{}</a>', reverse(tail, kwargs=dict(task_pk=task.pk)), text)
+        except NoReverseMatch:
+            pass
+    return text
+
+
+class _LogRows(list):
+    # The rows of the logs table for one page of runs. The "Older runs" link reads the page back from the table's rows, so it's only loaded once. Only the first LOG_LINES_PER_RUN lines of each run are decompressed and shown.
+    def __init__(self, task, request):
+        try:
+            before = int(request.GET['logs_before'])
+        except (KeyError, ValueError):
+            before = None
+        self.logs = task.recent_logs(before=before)
+        self.oldest_log_id = self.logs[-1].pk if len(self.logs) >= LOG_RUNS_PER_PAGE else None
 
-from urd import get_tasks
-from urd.models import LogItem
+        super().__init__()
+        for log in self.logs:
+            lines = list(islice(log.lines(), LOG_LINES_PER_RUN))
+            self.extend(Struct(execution_time=log.execution_time, usage=log, data=line) for line in lines)
+            hidden = sum(chunk.line_count for chunk in log.chunks.all()) - len(lines)
+            if hidden > 0:
+                self.append(Struct(execution_time=log.execution_time, usage=log, data=_more_lines(task, hidden, newest=before is None and log is self.logs[0])))
+
+
+def _format_usage(usage):
+    return (
+        f'CPU {usage["cpu_user"]:.3f}s user, {usage["cpu_system"]:.3f}s system. '
+        f'Peak RSS {usage["max_rss"] / 1024 / 1024:.1f} MB. '
+        f'Blocks {usage["block_input"]} in, {usage["block_output"]} out. '
+        f'Context switches {usage["voluntary_switches"]} voluntary, {usage["involuntary_switches"]} involuntary.'
+    )
+
+
+def _format_log_usage(log):
+    parts = []
+    if log.usage:
+        parts.append(_format_usage(log.usage))
+    if log.process_usage:
+        parts.append(gettext('Worker process total: ') + _format_usage(log.process_usage))
+    return ' '.join(parts)
 
 
 class Meta:
@@ -22,28 +84,30 @@ class Meta:
         ),
     )
 
-    parts__list_urd_logitem = dict(
-        auto__include=['log__execution_time', 'log__task', 'data'],
-        columns=dict(
-            edit__include=False,
-            delete__include=False,
-            select__include=False,
-            log_execution_time__auto_rowspan=True
-        ),
-        bulk__include=False,
-        actions__create__include=False,
-    )
-
     parts__edit_urd_task__fields = dict(
         last_checked__include=False,
         shutdown_command__include=False,
         pid__editable=False,
+        host__editable=False,
+        owner__editable=False,
+        lease_expires__editable=False,
+        crash_count__editable=False,
+        crash_backoff_until__editable=False,
 
         logs=Table(
-            auto__model=LogItem,
-            auto__include=['log__execution_time', 'log__task', 'data'],
-            rows=lambda instance, **_: LogItem.objects.filter(log__task=instance),
-            columns__log_execution_time__auto_rowspan=True,
+            columns=dict(
+                execution_time=Column(auto_rowspan=True),
+                # The value is the log, so that runs with the same usage aren't joined
+                usage=Column(auto_rowspan=True, cell__format=lambda value, **_: _format_log_usage(value)),
+                data=Column(),
+            ),
+            # Only the most recent runs are loaded. Older runs are paged by log id.
+            rows=lambda instance, request, **_: _LogRows(instance, request),
+            actions__older=Action(
+                display_name=gettext('Older runs'),
+                attrs__href=lambda table, **_: f'?logs_before={table.initial_rows.oldest_log_id}',
+                include=lambda table, **_: table.initial_rows.oldest_log_id is not None,
+            ),
         )
     )
 
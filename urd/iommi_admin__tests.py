@@ -1,6 +1,23 @@
+from datetime import timedelta
+from unittest import mock
+from uuid import uuid4
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from iommi.admin import Admin
 
-from tests.helpers import req
+from tests.helpers import (
+    req,
+    staff_req,
+)
+from urd import iommi_admin
+from urd.models import (
+    Log,
+    LogChunk,
+    Task,
+)
 
 
 def test_iommi_admin():
@@ -8,3 +25,74 @@ def test_iommi_admin():
         pass
 
     MyAdmin.all_models().bind(request=req('get')).render_to_response()
+
+
+@pytest.mark.django_db
+def test_edit_task_only_shows_recent_runs():
+    class MyAdmin(Admin):
+        class Meta(iommi_admin.Meta):
+            pass
+
+    task = Task.objects.create(name='test', function='tests.tasks.test_task', interval=timedelta(seconds=1), crash_count=4)
+    logs = []
+    for i in range(5):
+        log = Log.objects.create(task=task, execution_time=timezone.now(), run_id=uuid4(), usage=dict(
+            cpu_user=0.25, cpu_system=0.125, max_rss=50 * 1024 * 1024, block_input=1, block_output=2, voluntary_switches=3, involuntary_switches=4,
+        ))
+        LogChunk.objects.create(log=log, line_count=1, data=LogChunk.pack([f'output of run {i}']))
+        logs.append(log)
+
+    assert task.recent_logs() == logs[:-4:-1]
+    assert task.recent_logs(before=logs[2].pk) == logs[1::-1]
+
+    def render(**params):
+        admin = MyAdmin.edit().refine_with_params(app_name='urd', model_name='task', pk=task.pk).refine_done()
+        return admin.bind(request=staff_req('get', **params)).render_to_response().content.decode()
+
+    content = render()
+    assert 'output of run 4' in content
+    assert 'output of run 2' in content
+    assert 'output of run 1' not in content
+    assert f'?logs_before={logs[2].pk}' in content
+    assert 'CPU 0.250s user, 0.125s system. Peak RSS 50.0 MB.' in content
+    assert 'Crash count' in content
+
+    content = render(logs_before=logs[2].pk)
+    assert 'output of run 1' in content
+    assert 'output of run 2' not in content
+    assert f'?logs_before={logs[1].pk}' not in content
+
+    # The page of logs is loaded once, even though both the rows and the link use it
+    with CaptureQueriesContext(connection) as queries:
+        render()
+    assert len([q for q in queries if 'urd_logchunk' in q['sql']]) == 1
+
+    content = render(logs_before='abc')
+    assert 'output of run 4' in content
+
+
+@pytest.mark.django_db
+def test_edit_task_caps_the_lines_shown_per_run():
+    class MyAdmin(Admin):
+        class Meta(iommi_admin.Meta):
+            pass
+
+    task = Task.objects.create(name='test', function='tests.tasks.test_task', interval=timedelta(seconds=1))
+    for run in range(2):
+        log = Log.objects.create(task=task, execution_time=timezone.now(), run_id=uuid4())
+        for chunk in range(3):
+            LogChunk.objects.create(log=log, line_count=2, data=LogChunk.pack([f'run {run} line {chunk * 2 + i}' for i in range(2)]))
+
+    admin = MyAdmin.edit().refine_with_params(app_name='urd', model_name='task', pk=task.pk).refine_done()
+    with mock.patch('urd.iommi_admin.LOG_LINES_PER_RUN', 3), mock.patch('urd.models.LogChunk.lines', autospec=True, side_effect=LogChunk.lines) as lines:
+        content = admin.bind(request=staff_req('get')).render_to_response().content.decode()
+
+    assert 'run 1 line 2' in content
+    assert 'run 1 line 3' not in content
+    assert 'run 0 line 2' in content
+    assert 'run 0 line 3' not in content
+    # Chunks past the cap aren't decompressed
+    assert lines.call_count == 4
+    # The newest run links to the tail view for the rest
+    assert f'<a href="/tail/{task.pk}/">3 more lines</a>' in content
+    assert content.count('3 more lines') == 2
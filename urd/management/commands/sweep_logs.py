@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from urd.retention import sweep_logs
+
+
+class Command(BaseCommand):
+    help = 'Delete old logs according to the retention settings. The monitor also does this periodically.'
+
+    def handle(self, *args, **options):
+        print('Swept {logs} logs with {chunks} chunks of output in {seconds:.3f}s'.format(**sweep_logs()))
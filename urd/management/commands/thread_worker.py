@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from urd.worker import run_thread_worker
+
+
+class Command(BaseCommand):
+    help = 'Worker process that runs tasks with execution mode thread on threads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--control-fd', type=int, required=True, help='File descriptor of the control pipe from the monitor')
+        parser.add_argument('--status-fd', type=int, required=True, help='File descriptor of the pipe for reporting exit codes to the monitor')
+
+    def handle(self, *args, **options):
+        exit(run_thread_worker(options['control_fd'], options['status_fd']))
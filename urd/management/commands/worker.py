@@ -1,7 +1,6 @@
 from django.core.management.base import BaseCommand
 
-from urd.models import Task
-from urd.worker import worker
+from urd.worker import run_worker
 
 
 class Command(BaseCommand):
@@ -9,7 +8,7 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('task_pk', type=str)
+        parser.add_argument('--control-fd', type=int, help='File descriptor of the control pipe from the monitor')
 
     def handle(self, *args, **options):
-        task = Task.objects.get(pk=options['task_pk'])
-        exit(worker(task))
+        exit(run_worker(options['task_pk'], control_fd=options['control_fd']))
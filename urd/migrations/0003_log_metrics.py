@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('urd', '0002_alter_logitem_options_alter_task_function'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='log',
+            name='duration',
+            field=models.DurationField(null=True),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='exit_reason',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='heartbeat_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='lag',
+            field=models.DurationField(null=True),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='missed_slots',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('urd', '0003_log_metrics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Node',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('environment', models.CharField(max_length=255)),
+                ('last_seen', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='host',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='lease_expires',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='owner',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
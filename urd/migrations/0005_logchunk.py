@@ -0,0 +1,56 @@
+import zlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+CHUNK_LINES = 1000
+
+
+def pack_log_items(apps, schema_editor):
+    Log = apps.get_model('urd', 'Log')
+    LogItem = apps.get_model('urd', 'LogItem')
+    LogChunk = apps.get_model('urd', 'LogChunk')
+
+    for log_id in Log.objects.values_list('pk', flat=True).iterator():
+        lines = list(LogItem.objects.filter(log_id=log_id).order_by('pk').values_list('data', flat=True))
+        LogChunk.objects.bulk_create([
+            LogChunk(log_id=log_id, line_count=len(batch), data=zlib.compress('\n'.join(batch).encode()))
+            for batch in (lines[i:i + CHUNK_LINES] for i in range(0, len(lines), CHUNK_LINES))
+        ])
+
+
+def unpack_log_chunks(apps, schema_editor):
+    LogItem = apps.get_model('urd', 'LogItem')
+    LogChunk = apps.get_model('urd', 'LogChunk')
+
+    for chunk in LogChunk.objects.order_by('pk').iterator():
+        LogItem.objects.bulk_create([
+            LogItem(log_id=chunk.log_id, data=line)
+            for line in zlib.decompress(chunk.data).decode().split('\n')
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('urd', '0004_cluster_leases'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line_count', models.IntegerField()),
+                ('data', models.BinaryField()),
+                ('log', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='urd.log')),
+            ],
+            options={
+                'ordering': ('pk',),
+            },
+        ),
+        migrations.RunPython(pack_log_items, unpack_log_chunks),
+        migrations.DeleteModel(
+            name='LogItem',
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('urd', '0005_logchunk'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(fields=['task', 'id'], name='urd_log_task_id_id'),
+        ),
+        migrations.AddIndex(
+            model_name='logchunk',
+            index=models.Index(fields=['log', 'id'], name='urd_logchunk_log_id_id'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('urd', '0006_log_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='execution_mode',
+            field=models.CharField(choices=[('process', 'Process'), ('thread', 'Thread')], default='process', max_length=255),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('urd', '0007_execution_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='log',
+            name='process_usage',
+            field=models.JSONField(null=True),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='usage',
+            field=models.JSONField(null=True),
+        ),
+    ]
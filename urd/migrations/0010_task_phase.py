@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('urd', '0009_task_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='phase',
+            field=models.DurationField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:57
+
+import datetime
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('urd', '0010_task_phase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='heartbeat_timeout',
+            field=models.DurationField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(datetime.timedelta(seconds=10))]),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='max_runtime',
+            field=models.DurationField(blank=True, null=True),
+        ),
+    ]
@@ -1,31 +1,59 @@
+import asyncio
 import contextlib
+import inspect
 import os
-from datetime import timedelta
-from importlib import import_module
+import sys
+import zlib
+from socket import gethostname
+from datetime import (
+    datetime,
+    timedelta,
+    timezone as dt_timezone,
+)
 from time import sleep
 from uuid import uuid4
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.db import transaction
+from django.core.validators import MinValueValidator
+from django.db import (
+    connections,
+    transaction,
+)
 from django.db.models import (
+    BinaryField,
     BooleanField,
     CASCADE,
     CharField,
     DateTimeField,
     DurationField,
     ForeignKey,
+    Index,
     IntegerField,
+    JSONField,
     Model,
-    TextField,
+    Q,
     UUIDField,
 )
 from django.utils import timezone
 
 from urd import (
+    CONTROLLED_HEARTBEAT_INTERVAL,
+    FunctionNotFound,
+    get_task_function,
+    HEARTBEAT_INTERVAL,
+    LOG_RUNS_PER_PAGE,
+    MIN_HEARTBEAT_TIMEOUT,
     SHUTDOWN_TIMEOUT,
     ShuttingDown,
 )
 
+# Databases that support UPDATE ... RETURNING
+LEASE_VENDORS = {'postgresql', 'sqlite'}
+
+# Phases are relative to this, so that slots don't depend on when a task was created
+PHASE_EPOCH = datetime(2000, 1, 1, tzinfo=dt_timezone.utc)
+
 
 class Task(Model):
     name = CharField(max_length=255)
@@ -38,54 +66,184 @@ class Task(Model):
     disabled = BooleanField(default=False)
     current_run_id = UUIDField(null=True)
     environment = CharField(max_length=255)
+    # The host of the worker holding the lock. PIDs are only unique per host.
+    host = CharField(max_length=255, blank=True)
+    # The monitor node that is responsible for running this task, see urd.monitor
+    owner = CharField(max_length=255, blank=True)
+    lease_expires = DateTimeField(null=True)
+    # Small tasks that run often can share a worker process, and run on a thread there. See urd.worker.run_thread_worker
+    execution_mode = CharField(max_length=255, choices=[('process', 'Process'), ('thread', 'Thread')], default='process')
+    # When the monitor is at its worker limit, higher priority tasks are started first
+    priority = IntegerField(default=0)
+    # Offset of the execution slots within the interval. With URD_STAGGER, tasks without one get an offset derived from their id.
+    phase = DurationField(null=True, blank=True)
+    # Enforced by the monitor, which terminates and then kills a worker whose run takes longer, or that hasn't checked its lock for this long
+    max_runtime = DurationField(null=True, blank=True)
+    heartbeat_timeout = DurationField(null=True, blank=True, validators=[MinValueValidator(MIN_HEARTBEAT_TIMEOUT)])
+    # Failed runs are retried in the worker, with backoff, as long as the retry is before the next slot
+    max_retries = IntegerField(default=0)
+    # Workers that keep crashing right after they are started, see Monitor.record_exit
+    crash_count = IntegerField(default=0)
+    crash_backoff_until = DateTimeField(null=True, blank=True)
+
+    def phase_offset(self):
+        if self.phase is not None:
+            return self.phase % self.interval
+        if getattr(settings, 'URD_STAGGER', False):
+            # Deterministic, and spread evenly over the interval
+            return self.interval * (zlib.crc32(str(self.pk).encode()) / 2 ** 32)
+        return None
+
+    def align(self, time):
+        # The first slot at or after `time`, for tasks with a phase
+        phase_offset = self.phase_offset()
+        if phase_offset is None:
+            return time
+        epoch = PHASE_EPOCH if timezone.is_aware(time) else PHASE_EPOCH.replace(tzinfo=None)
+        offset = (time - epoch - phase_offset) % self.interval
+        return time if not offset else time + self.interval - offset
 
-    def calculate_number_of_execution_slots_passed(self):
+    def calculate_number_of_execution_slots_passed(self, now=None):
         assert self.interval.total_seconds() > 0
+        if now is None:
+            now = timezone.now()
         count = 0
         if self.next_execution_time is None:
-            self.next_execution_time = timezone.now() + self.interval
+            self.next_execution_time = now + self.interval
             count += 1
         else:
-            while timezone.now() >= self.next_execution_time:
-                self.next_execution_time = self.next_execution_time + self.interval
-                count += 1
-            if count:
+            if now >= self.next_execution_time:
+                count = (now - self.next_execution_time) // self.interval + 1
+                self.next_execution_time = self.align(self.next_execution_time + self.interval * count)
                 self.save(update_fields=['next_execution_time'])
         return count
 
+    heartbeat_count = 0
+
+    # Set by the worker when the monitor gave it a control channel, see urd.control
+    control = None
+
     def heartbeat(self):
+        self.check_control()
         if self.last_checked is not None and (timezone.now() - self.last_checked) > SHUTDOWN_TIMEOUT:
             print('WARNING', 'heartbeat not called often enough for', self.name)
-        if self.last_checked is None or (timezone.now() - self.last_checked) > timedelta(seconds=1):
+        if self._heartbeat_due():
+            # Write buffered output to the log
+            sys.stdout.flush()
             self.check_lock()
-            self.last_checked = timezone.now()
-            self.save(update_fields=['last_checked'])
 
-    def check_lock(self):
-        t = Task.objects.get(pk=self.pk)
-        if t.pid != os.getpid() or t.pid is None:
-            raise ShuttingDown('PID changed')
-
-        if t.shutdown_command:
-            t.pid = None
-            t.shutdown_command = None
-            t.current_run_id = None
-            t.save(update_fields=['pid', 'shutdown_command', 'current_run_id'])
+    def _heartbeat_due(self):
+        # With a control channel, shutdowns and interval changes are pushed to us, so the database is only a fallback
+        heartbeat_interval = HEARTBEAT_INTERVAL if self.control is None else CONTROLLED_HEARTBEAT_INTERVAL
+        return self.last_checked is None or (timezone.now() - self.last_checked) > heartbeat_interval
+
+    # Heartbeats happen inside the transaction of the task. Their queries go through a connection of their own in autocommit mode, like the output in urd.worker.Logger, so that last_checked is committed right away and the task row isn't locked for the whole run.
+    _lock_connection = None
+
+    def lock_connection(self):
+        if self._lock_connection is None:
+            self._lock_connection = connections.create_connection('default')
+            # Async tasks heartbeat from the thread of sync_to_async
+            self._lock_connection.inc_thread_sharing()
+        return self._lock_connection
+
+    def close_lock_connection(self):
+        if self._lock_connection is not None:
+            self._lock_connection.close()
+            self._lock_connection = None
+
+    def _release_lock(self, cursor):
+        quote_name = self.lock_connection().ops.quote_name
+        cursor.execute(
+            f'UPDATE {quote_name(self._meta.db_table)} SET {quote_name("pid")} = NULL, {quote_name("shutdown_command")} = NULL, {quote_name("current_run_id")} = NULL '
+            f'WHERE {quote_name("id")} = %s AND {quote_name("pid")} = %s AND {quote_name("host")} = %s',
+            [self.pk, os.getpid(), gethostname()],
+        )
+
+    def renew_lease(self):
+        # Renew the lease and read back the schedule in one statement. Returns False if we don't hold the lease anymore, or if there is a shutdown command.
+        now = timezone.now()
+        lock_connection = self.lock_connection()
+        quote_name = lock_connection.ops.quote_name
+        with lock_connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {quote_name(self._meta.db_table)} SET {quote_name("last_checked")} = %s '
+                f'WHERE {quote_name("id")} = %s AND {quote_name("pid")} = %s AND {quote_name("host")} = %s AND {quote_name("shutdown_command")} IS NULL '
+                f'RETURNING {quote_name("interval")}, {quote_name("next_execution_time")}',
+                [lock_connection.ops.adapt_datetimefield_value(now), self.pk, os.getpid(), gethostname()],
+            )
+            row = cursor.fetchone()
+
+        if row is None:
+            return False
+
+        self.last_checked = now
+        interval, next_execution_time = [_from_db_value(lock_connection, name, value) for name, value in zip(['interval', 'next_execution_time'], row)]
+        if interval != self.interval:
+            self.interval = interval
+            self.next_execution_time = next_execution_time
+        return True
+
+    def _counted_heartbeat(self):
+        self.heartbeat_count += 1
+        self.heartbeat()
+
+    async def _async_heartbeat(self):
+        self.heartbeat_count += 1
+        # The database can't be used from the event loop. Most heartbeats only check a flag and the clock though, so we only go to a thread when there is something to do.
+        if (self.control is not None and self.control.shutdown) or self._heartbeat_due():
+            await sync_to_async(self.heartbeat)()
+
+    def check_control(self):
+        if self.control is not None and self.control.shutdown:
+            with self.lock_connection().cursor() as cursor:
+                self._release_lock(cursor)
             raise ShuttingDown('Got shutdown command')
 
-        if t.interval != self.interval:
-            self.interval = t.interval
-            self.next_execution_time = t.next_execution_time
+    def check_lock(self):
+        lock_connection = self.lock_connection()
+        if lock_connection.vendor in LEASE_VENDORS and self.renew_lease():
+            return
+
+        quote_name = lock_connection.ops.quote_name
+        fields = ['pid', 'host', 'shutdown_command', 'interval', 'next_execution_time']
+        with lock_connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT {", ".join(quote_name(name) for name in fields)} FROM {quote_name(self._meta.db_table)} WHERE {quote_name("id")} = %s',
+                [self.pk],
+            )
+            row = cursor.fetchone()
+            if row is None:
+                raise ShuttingDown('PID changed')
+            pid, host, shutdown_command, interval, next_execution_time = [_from_db_value(lock_connection, name, value) for name, value in zip(fields, row)]
+            if pid != os.getpid() or pid is None or host != gethostname():
+                raise ShuttingDown('PID changed')
+
+            if shutdown_command:
+                self._release_lock(cursor)
+                raise ShuttingDown('Got shutdown command')
+
+            if interval != self.interval:
+                self.interval = interval
+                self.next_execution_time = next_execution_time
+
+            self.last_checked = timezone.now()
+            cursor.execute(
+                f'UPDATE {quote_name(self._meta.db_table)} SET {quote_name("last_checked")} = %s WHERE {quote_name("id")} = %s',
+                [lock_connection.ops.adapt_datetimefield_value(self.last_checked), self.pk],
+            )
 
     def execute(self):
         if not hasattr(self, '_function'):
-            m, _, f = self.function.rpartition('.')
             try:
-                self._function = getattr(import_module(m), f)
+                self._function = get_task_function(self.function)
             except (ImportError, AttributeError) as e:
                 print('ERROR', 'Failed to execute function: ', str(e) or str(type(e)))
                 sleep(1)
-                raise ShuttingDown('Failed to execute function')
+                raise FunctionNotFound('Failed to execute function')
+
+        if inspect.iscoroutinefunction(self._function):
+            return asyncio.run(self._execute_async())
 
         # SQLite will fail if you try to write to the database outside the current transaction, if you have one. So for sqlite we have to not use a transaction atomic block.
         atomic = transaction.atomic if 'sqlite' not in settings.DATABASES['default']['ENGINE'] else contextlib.nullcontext
@@ -94,9 +252,37 @@ class Task(Model):
 
         with atomic():
             self.heartbeat()
-            return self._function(heartbeat=lambda: self.heartbeat())
+            return self._function(heartbeat=self._counted_heartbeat)
+
+    async def _execute_async(self):
+        # Async tasks don't run in a transaction, since the database is used from other threads. A shutdown cancels the task, instead of waiting for the next heartbeat.
+        loop = asyncio.get_running_loop()
+        main = asyncio.current_task()
+
+        def cancel():
+            try:
+                loop.call_soon_threadsafe(main.cancel)
+            except RuntimeError:
+                # The run is already over
+                pass
+
+        if self.control is not None:
+            self.control.on_shutdown = cancel
+        try:
+            await sync_to_async(self.heartbeat)()
+            return await self._function(heartbeat=self._async_heartbeat)
+        except asyncio.CancelledError:
+            await sync_to_async(self.check_control)()
+            raise ShuttingDown('Cancelled')
+        finally:
+            if self.control is not None:
+                self.control.on_shutdown = None
 
     def wait_for_previous_shutdown(self):
+        # Another worker that still holds the lock is asked to shut down, and gets SHUTDOWN_TIMEOUT to do so
+        if self.pid is not None and self.shutdown_command is None and (self.pid, self.host) != (os.getpid(), gethostname()):
+            Task.objects.filter(pk=self.pk, pid=self.pid, shutdown_command__isnull=True).update(shutdown_command=timezone.now())
+            self.refresh_from_db()
         while self.pid is not None and self.shutdown_command is not None and timezone.now() < (self.shutdown_command + SHUTDOWN_TIMEOUT):
             sleep(0.1)
             self.refresh_from_db()
@@ -104,16 +290,30 @@ class Task(Model):
             print('Shutdown timeout hit')
 
     def start(self):
-        self.pid = os.getpid()
-        self.shutdown_command = None
-        self.current_run_id = uuid4()
-        self.save(update_fields=['pid', 'shutdown_command', 'current_run_id'])
+        # Take the lock in one conditional UPDATE, so that two workers can't both get it. The lock of a worker that didn't shut down in time is stale.
+        now = timezone.now()
+        values = dict(pid=os.getpid(), host=gethostname(), shutdown_command=None, current_run_id=uuid4())
+        if self.next_execution_time is None and self.phase_offset() is not None:
+            # A new task waits for its first slot, so tasks created together don't all run at once
+            values['next_execution_time'] = self.align(now)
+        free = Q(pid__isnull=True) | Q(pid=os.getpid(), host=gethostname()) | Q(shutdown_command__lte=now - SHUTDOWN_TIMEOUT)
+        if not Task.objects.filter(free, pk=self.pk).update(**values):
+            raise ShuttingDown('Locked by another worker')
+        for name, value in values.items():
+            setattr(self, name, value)
 
     def time_to_next_execution(self):
         if self.next_execution_time is None:
             return timedelta()
         return self.next_execution_time - timezone.now()
 
+    def recent_logs(self, before=None, count=LOG_RUNS_PER_PAGE):
+        # Keyset pagination from the newest run, using the (task_id, id) index
+        logs = self.logs.order_by('-pk')
+        if before is not None:
+            logs = logs.filter(pk__lt=before)
+        return list(logs.prefetch_related('chunks')[:count])
+
     def disable(self):
         Task.objects.filter(pk=self.pk).update(disabled=True)
 
@@ -124,24 +324,69 @@ class Task(Model):
         return self.name
 
 
+def _from_db_value(connection, field_name, value):
+    expression = Task._meta.get_field(field_name).get_col(Task._meta.db_table)
+    for converter in connection.ops.get_db_converters(expression) + expression.get_db_converters(connection):
+        value = converter(value, expression, connection)
+    return value
+
+
+class Node(Model):
+    name = CharField(max_length=255, unique=True)
+    environment = CharField(max_length=255)
+    last_seen = DateTimeField()
+
+    def __str__(self):
+        return self.name
+
+
 class Log(Model):
     execution_time = DateTimeField()
     task = ForeignKey(Task, related_name='logs', on_delete=CASCADE)
     run_id = UUIDField()
+    duration = DurationField(null=True)
+    lag = DurationField(null=True)
+    missed_slots = IntegerField(default=0)
+    heartbeat_count = IntegerField(default=0)
+    exit_reason = CharField(max_length=255, blank=True)
+    retries = IntegerField(default=0)
+    # getrusage deltas of the run, see urd.worker.resource_usage
+    usage = JSONField(null=True)
+    # Totals for the whole worker process, recorded by the monitor on the last run of the process
+    process_usage = JSONField(null=True)
 
     class Meta:
         ordering = ('pk',)
+        indexes = [
+            Index(fields=['task', 'id'], name='urd_log_task_id_id'),
+        ]
 
     def __str__(self):
         return f'{self.task.name} - {self.execution_time}'
 
+    def lines(self):
+        for chunk in self.chunks.all():
+            yield from chunk.lines()
+
 
-class LogItem(Model):
-    log = ForeignKey(Log, related_name='items', on_delete=CASCADE)
-    data = TextField()
+# Output is stored as zlib compressed chunks of newline separated lines, written by urd.worker.Logger
+class LogChunk(Model):
+    log = ForeignKey(Log, related_name='chunks', on_delete=CASCADE)
+    line_count = IntegerField()
+    data = BinaryField()
 
     def __str__(self):
-        return self.data
+        return f'{self.log} - {self.line_count} lines'
+
+    def lines(self):
+        return zlib.decompress(self.data).decode().split('\n')
+
+    @staticmethod
+    def pack(lines):
+        return zlib.compress('\n'.join(lines).encode())
 
     class Meta:
         ordering = ('pk',)
+        indexes = [
+            Index(fields=['log', 'id'], name='urd_logchunk_log_id_id'),
+        ]
@@ -0,0 +1,736 @@
+import contextlib
+import heapq
+import math
+import os
+import resource
+import selectors
+import signal
+import subprocess
+import sys
+import traceback
+from datetime import timedelta
+from functools import lru_cache
+from socket import gethostname
+from time import (
+    monotonic,
+    sleep,
+)
+
+from django.conf import settings
+from django.db import (
+    close_old_connections,
+    connections,
+)
+from django.db.models import (
+    Max,
+    Q,
+)
+from django.utils import timezone
+
+from urd import (
+    CRASH_BACKOFF,
+    CRASH_BACKOFF_MAX,
+    CRASH_LOOP_THRESHOLD,
+    CRASH_LOOP_WINDOW,
+    EXIT_SWEEP_INTERVAL,
+    get_node_name,
+    get_tasks,
+    LEASE_DURATION,
+    LEASE_RENEW_INTERVAL,
+    MIN_HEARTBEAT_TIMEOUT,
+    MONITOR_POLL_INTERVAL,
+    REAP_CHECK_INTERVAL,
+    SHUTDOWN_EXIT_CODE,
+    SHUTDOWN_TIMEOUT,
+    SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE,
+    SPAWN_LEAD_TIME,
+    THREAD_WORKERS,
+)
+from urd.control import (
+    ControlChannel,
+    TaskChannel,
+)
+from urd.models import (
+    Log,
+    Node,
+    Task,
+)
+from urd.retention import LogSweeper
+from urd.worker import (
+    backoff,
+    run_thread_worker,
+    resource_usage,
+    run_worker,
+)
+
+
+def max_workers(env):
+    # Per monitor, so per node. It counts running tasks, including each task in thread mode, since they each hold a slot.
+    limits = [
+        getattr(settings, 'URD_MAX_WORKERS', None),
+        getattr(settings, 'URD_MAX_WORKERS_BY_ENVIRONMENT', {}).get(env),
+    ]
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if limits else None
+
+
+@lru_cache(maxsize=None)
+def parse_environments(environment):
+    return frozenset(x.strip() for x in environment.lower().split(','))
+
+
+# Exit code for a return value, like sys.exit(): None is success, and anything that isn't an int is printed
+def _exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+# Popen-like handle for a forked child that runs `target` and exits with its return value
+class ForkedProcess:
+    def __init__(self, target):
+        # Database connections can't be shared with the child, so they must be closed before forking
+        connections.close_all()
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        self.returncode = None
+        self.pid = os.fork()
+        if self.pid == 0:
+            exit_code = SHUTDOWN_EXIT_CODE
+            # The child must never return, or it would go on to run the loop of the monitor
+            try:
+                try:
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    exit_code = target()
+                except SystemExit as e:
+                    # Workers exit like this on SIGTERM
+                    exit_code = e.code
+                except BaseException:
+                    traceback.print_exc()
+                exit_code = _exit_code(exit_code)
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(exit_code if isinstance(exit_code, int) else 1)
+
+    rusage = None
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status, rusage = os.wait4(self.pid, os.WNOHANG)
+            if pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+                self.rusage = rusage
+        return self.returncode
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def send_signal(self, signum):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signum)
+            except ProcessLookupError:
+                pass
+
+
+# Reaps with wait4 instead of waitpid, to get the resource usage of the worker
+class WorkerProcess(subprocess.Popen):
+    rusage = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, status, rusage = os.wait4(self.pid, os.WNOHANG)
+            except ChildProcessError:
+                return super().poll()
+            if pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+                self.rusage = rusage
+        return self.returncode
+
+
+# A worker process that runs tasks on threads, see urd.worker.run_thread_worker
+class ThreadWorker:
+    def __init__(self, process, channel, status_fd):
+        self.process = process
+        self.channel = channel
+        self.status_fd = status_fd
+        self.handle_by_pk = {}
+        self._partial = b''
+
+    def run(self, task):
+        handle = ThreadHandle(self, task.pk)
+        self.handle_by_pk[task.pk] = handle
+        self.channel.send('run', str(task.pk))
+        return handle
+
+    def collect(self):
+        # Read the exit codes the thread worker has reported
+        while self.status_fd is not None:
+            try:
+                data = os.read(self.status_fd, 4096)
+            except BlockingIOError:
+                break
+            if not data:
+                # The process is gone. The read end is closed, so the monitor doesn't keep waking up for it.
+                os.close(self.status_fd)
+                self.status_fd = None
+                break
+            *lines, self._partial = (self._partial + data).split(b'\n')
+            for line in lines:
+                _, task_pk, exit_code = line.decode().split()
+                handle = self.handle_by_pk.pop(int(task_pk), None)
+                if handle is not None:
+                    handle.returncode = int(exit_code)
+
+        if self.process.poll() is not None:
+            for handle in self.handle_by_pk.values():
+                handle.returncode = self.process.returncode
+            self.handle_by_pk = {}
+
+    def close(self):
+        self.channel.close()
+        if self.status_fd is not None:
+            os.close(self.status_fd)
+            self.status_fd = None
+
+
+# Popen-like handle for a task running on a thread of a ThreadWorker
+class ThreadHandle:
+    def __init__(self, thread_worker, task_pk):
+        self.thread_worker = thread_worker
+        self.task_pk = task_pk
+        self.pid = thread_worker.process.pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            self.thread_worker.collect()
+        return self.returncode
+
+    def terminate(self):
+        # A thread can't be killed, so this is all we can do. Tasks that don't call heartbeat() will keep running.
+        if self.returncode is None:
+            self.thread_worker.channel.send('shutdown', str(self.task_pk))
+
+    def kill(self):
+        # The only way to stop a hung thread. The other tasks of the thread worker are started again in a new one.
+        if self.returncode is None:
+            print('Killing thread worker', self.pid, 'to stop task', self.task_pk)
+            self.thread_worker.process.kill()
+
+
+class Monitor:
+    def __init__(self, env, fork_server=False):
+        self.env = env
+        self.fork_server = fork_server
+        self.running = True
+        self.process_by_task = {}
+        self.channel_by_task = {}
+        self.thread_workers = {}
+        self.max_workers = max_workers(env)
+        # Tasks whose workers have been asked to give up their slot
+        self.released = set()
+        self.thread_worker_count = getattr(settings, 'URD_THREAD_WORKERS', THREAD_WORKERS)
+        # Processes that have been told to shut down: task -> (process, deadline, what to do at the deadline: 'terminate', 'kill' or None if it has been killed)
+        self.stopping = {}
+        # Why the monitor stopped a worker, recorded as the exit reason of its run
+        self.reap_reason_by_task = {}
+        self.last_reap_check = None
+        self.task_by_pk = {}
+        self.node = get_node_name()
+        # Tasks this node holds the lease for. Only those are run here.
+        self.owned_pks = set()
+        self.last_lease_update = None
+        self.log_sweeper = LogSweeper()
+        self.poll_interval = getattr(settings, 'URD_MONITOR_POLL_INTERVAL', MONITOR_POLL_INTERVAL)
+        self._rows = None
+        # Set up by watch() in run(): SIGCHLD and reports from thread workers wake the monitor, and exits are only looked for then
+        self.selector = None
+        self.wakeup_fds = None
+        self.watched_by_fd = {}
+        self.exits_pending = True
+        self.last_exit_check = None
+        # Heap of (spawn time, task pk). It's rebuilt whenever the tasks change, and tasks are pushed again when their process exits.
+        self._queue = []
+
+    def refresh_tasks(self):
+        # A narrow query every tick is cheap. We only build model instances when the set of tasks actually changed.
+        rows = list(Task.objects.filter(disabled=False).values_list('pk', 'environment', 'interval', 'next_execution_time', 'shutdown_command', 'priority', 'max_runtime', 'heartbeat_timeout', 'execution_mode', 'phase'))
+        if rows == self._rows:
+            return False
+        self._rows = rows
+
+        rows_by_pk = {
+            pk: (interval, next_execution_time, shutdown_command, priority, max_runtime, heartbeat_timeout, execution_mode, phase)
+            for pk, environment, interval, next_execution_time, shutdown_command, priority, max_runtime, heartbeat_timeout, execution_mode, phase in rows
+            if self.env in parse_environments(environment)
+        }
+
+        new_pks = rows_by_pk.keys() - self.task_by_pk.keys()
+        self.task_by_pk = {pk: task for pk, task in self.task_by_pk.items() if pk in rows_by_pk}
+        if new_pks:
+            self.task_by_pk.update({task.pk: task for task in Task.objects.filter(pk__in=new_pks)})
+
+        for pk, (interval, next_execution_time, shutdown_command, priority, max_runtime, heartbeat_timeout, execution_mode, phase) in rows_by_pk.items():
+            task = self.task_by_pk[pk]
+            channel = self.channel_by_task.get(task)
+            if channel is not None:
+                if interval != task.interval:
+                    channel.interval(interval, next_execution_time)
+                if shutdown_command is not None:
+                    channel.shutdown()
+            # The worker can't switch to the other mode, and works out its slots from the phase, so it's restarted
+            restart = task in self.process_by_task and (execution_mode, phase) != (task.execution_mode, task.phase)
+            task.interval = interval
+            task.next_execution_time = next_execution_time
+            task.priority = priority
+            task.max_runtime = max_runtime
+            task.heartbeat_timeout = heartbeat_timeout
+            task.execution_mode = execution_mode
+            task.phase = phase
+            if restart:
+                print('Restarting', task, self.process_by_task[task].pid)
+                self.stop(task)
+
+        self._queue = [(self.spawn_time(task), pk) for pk, task in self.task_by_pk.items()]
+        heapq.heapify(self._queue)
+        return True
+
+    def update_leases(self):
+        # Every monitor node claims a fair share of the tasks of its environment, with a lease that it has to renew. If a node dies, its leases expire and the other nodes take over.
+        self.last_lease_update = monotonic()
+        now = timezone.now()
+        expires = now + LEASE_DURATION
+
+        Node.objects.update_or_create(name=self.node, defaults=dict(environment=self.env, last_seen=now))
+        live_nodes = Node.objects.filter(environment=self.env, last_seen__gt=now - LEASE_DURATION).count()
+        fair_share = math.ceil(len(self.task_by_pk) / max(live_nodes, 1))
+
+        Task.objects.filter(owner=self.node).update(lease_expires=expires)
+        owned = set(Task.objects.filter(owner=self.node).values_list('pk', flat=True)) & self.task_by_pk.keys()
+
+        if len(owned) < fair_share:
+            claimable = Q(owner='') | Q(lease_expires__lt=now)
+            candidates = list(Task.objects.filter(claimable, pk__in=self.task_by_pk.keys() - owned).values_list('pk', 'owner')[:fair_share - len(owned)])
+            pks = [pk for pk, _ in candidates]
+            # The condition is repeated in the update, in case another node got there first
+            Task.objects.filter(claimable, pk__in=pks).update(owner=self.node, lease_expires=expires)
+            # A worker of a dead node might still be running. Ask it to shut down, new workers wait for that.
+            taken_over = [pk for pk, previous_owner in candidates if previous_owner]
+            Task.objects.filter(pk__in=taken_over, owner=self.node, pid__isnull=False, shutdown_command__isnull=True).update(shutdown_command=now)
+        elif len(owned) > fair_share:
+            # Give back tasks that aren't running, so that new nodes get their share
+            idle = [pk for pk in owned if self.task_by_pk[pk] not in self.process_by_task][:len(owned) - fair_share]
+            Task.objects.filter(pk__in=idle, owner=self.node).update(owner='', lease_expires=None)
+
+        previously_owned = self.owned_pks
+        self.owned_pks = set(Task.objects.filter(owner=self.node).values_list('pk', flat=True))
+        for pk in self.owned_pks - previously_owned:
+            if pk in self.task_by_pk:
+                heapq.heappush(self._queue, (self.spawn_time(self.task_by_pk[pk]), pk))
+
+    def release_leases(self):
+        Task.objects.filter(owner=self.node).update(owner='', lease_expires=None)
+        Node.objects.filter(name=self.node).delete()
+
+    def spawn_time(self, task):
+        if task.next_execution_time is None:
+            spawn_time = timezone.now()
+        else:
+            spawn_time = task.next_execution_time - SPAWN_LEAD_TIME
+        if task.crash_backoff_until is not None:
+            return max(spawn_time, task.crash_backoff_until)
+        return spawn_time
+
+    def time_to_next_spawn(self):
+        if not self._queue:
+            return None
+        return (self._queue[0][0] - timezone.now()).total_seconds()
+
+    def close_pipes_in_child(self):
+        # A forked child must not keep the other workers' pipes open
+        for other in self.channel_by_task.values():
+            other.close()
+        for thread_worker in self.thread_workers.values():
+            thread_worker.close()
+        if self.wakeup_fds is not None:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            self.selector.close()
+            for fd in self.wakeup_fds:
+                os.close(fd)
+
+    def watch(self):
+        self.wakeup_fds = os.pipe()
+        for fd in self.wakeup_fds:
+            os.set_blocking(fd, False)
+        # Signals are written to the pipe, but only for signals with a Python handler
+        self._previous_wakeup_fd = signal.set_wakeup_fd(self.wakeup_fds[1])
+        self._previous_sigchld_handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.wakeup_fds[0], selectors.EVENT_READ)
+
+    def unwatch(self):
+        signal.set_wakeup_fd(self._previous_wakeup_fd)
+        signal.signal(signal.SIGCHLD, self._previous_sigchld_handler)
+        self.selector.close()
+        for fd in self.wakeup_fds:
+            os.close(fd)
+        self.selector = None
+        self.wakeup_fds = None
+        self.watched_by_fd = {}
+
+    def wait(self, timeout):
+        # Status pipes come and go with the thread workers. Closed pipes are dropped first, since their fd may have been reused.
+        for fd, thread_worker in list(self.watched_by_fd.items()):
+            if thread_worker.status_fd != fd:
+                del self.watched_by_fd[fd]
+                self.selector.unregister(fd)
+        for thread_worker in self.thread_workers.values():
+            if thread_worker.status_fd is not None and thread_worker.status_fd not in self.watched_by_fd:
+                self.watched_by_fd[thread_worker.status_fd] = thread_worker
+                self.selector.register(thread_worker.status_fd, selectors.EVENT_READ)
+
+        for key, _ in self.selector.select(timeout):
+            if key.fd == self.wakeup_fds[0]:
+                with contextlib.suppress(BlockingIOError):
+                    while os.read(key.fd, 4096):
+                        pass
+            self.exits_pending = True
+
+    def spawn(self, task):
+        if task.execution_mode == 'thread':
+            thread_worker = self.thread_worker_for(task)
+            self.channel_by_task[task] = TaskChannel(thread_worker.channel, task.pk)
+            return thread_worker.run(task)
+
+        channel = ControlChannel()
+        if self.fork_server:
+            def target():
+                self.close_pipes_in_child()
+                os.close(channel.write_fd)
+                return run_worker(task.pk, control_fd=channel.read_fd)
+
+            process = ForkedProcess(target)
+        else:
+            process = WorkerProcess(
+                [sys.executable, 'manage.py', 'worker', str(task.pk), '--control-fd', str(channel.read_fd)],
+                pass_fds=[channel.read_fd],
+            )
+        channel.close_read_end()
+        self.channel_by_task[task] = channel
+        return process
+
+    def thread_worker_for(self, task):
+        # Memory and process count grow with the number of thread workers, not with the number of tasks
+        index = task.pk % self.thread_worker_count
+        thread_worker = self.thread_workers.get(index)
+        if thread_worker is None or thread_worker.process.poll() is not None:
+            if thread_worker is not None:
+                thread_worker.collect()
+                thread_worker.close()
+            thread_worker = self.thread_workers[index] = self.spawn_thread_worker()
+            print('Starting thread worker', thread_worker.process.pid)
+        return thread_worker
+
+    def spawn_thread_worker(self):
+        channel = ControlChannel()
+        status_read_fd, status_write_fd = os.pipe()
+        os.set_blocking(status_read_fd, False)
+        if self.fork_server:
+            def target():
+                self.close_pipes_in_child()
+                os.close(channel.write_fd)
+                os.close(status_read_fd)
+                return run_thread_worker(channel.read_fd, status_write_fd)
+
+            process = ForkedProcess(target)
+        else:
+            process = WorkerProcess(
+                [sys.executable, 'manage.py', 'thread_worker', '--control-fd', str(channel.read_fd), '--status-fd', str(status_write_fd)],
+                pass_fds=[channel.read_fd, status_write_fd],
+            )
+        channel.close_read_end()
+        os.close(status_write_fd)
+        return ThreadWorker(process, channel, status_read_fd)
+
+    def record_process_usage(self, task, process):
+        # Threads of a thread worker have no usage of their own
+        if not isinstance(getattr(process, 'rusage', None), resource.struct_rusage):
+            return
+        last_log = Log.objects.filter(task=task, execution_time__gte=process.started).order_by('-pk').values_list('pk', flat=True).first()
+        if last_log is not None:
+            Log.objects.filter(pk=last_log).update(process_usage=resource_usage(process.rusage))
+
+    def clear_lock(self, task, process):
+        # The worker is gone, but it might not have got to release its lock
+        Task.objects.filter(pk=task.pk, pid=process.pid, host=gethostname()).update(pid=None, shutdown_command=None, current_run_id=None)
+
+    def record_reap(self, task, process):
+        self.clear_lock(task, process)
+        reason = self.reap_reason_by_task.pop(task, None)
+        if reason is not None:
+            last_log = Log.objects.filter(task=task, execution_time__gte=process.started).order_by('-pk').values_list('pk', flat=True).first()
+            if last_log is not None:
+                Log.objects.filter(pk=last_log).update(exit_reason=reason)
+
+    def close_channel(self, task):
+        channel = self.channel_by_task.pop(task, None)
+        if channel is not None:
+            channel.close()
+
+    def record_exit(self, task, process, exit_code):
+        # A worker that exits soon after it was started, other than to wait for the next execution, has crashed. Broken tasks would otherwise be started again and again, each time with a cold start.
+        now = timezone.now()
+        if exit_code != SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE and now - process.started < CRASH_LOOP_WINDOW:
+            task.crash_count += 1
+            if task.crash_count >= CRASH_LOOP_THRESHOLD:
+                delay = backoff(task.crash_count - CRASH_LOOP_THRESHOLD, CRASH_BACKOFF, getattr(settings, 'URD_CRASH_BACKOFF_MAX', CRASH_BACKOFF_MAX))
+                task.crash_backoff_until = now + delay
+                print('Crash loop', task, f'({task.crash_count} crashes), starting again in {delay.total_seconds():.1f}s')
+        elif task.crash_count:
+            task.crash_count = 0
+            task.crash_backoff_until = None
+        else:
+            return
+        Task.objects.filter(pk=task.pk).update(crash_count=task.crash_count, crash_backoff_until=task.crash_backoff_until)
+
+    def collect_exits(self):
+        # Clean out dead processes, and queue up their next execution
+        for task, process in list(self.process_by_task.items()):
+            exit_code = process.poll()
+            if exit_code is not None:
+                del self.process_by_task[task]
+                self.released.discard(task)
+                self.close_channel(task)
+                self.record_process_usage(task, process)
+                self.clear_lock(task, process)
+                self.record_exit(task, process, exit_code)
+                if task.pk in self.task_by_pk:
+                    heapq.heappush(self._queue, (self.spawn_time(task), task.pk))
+
+    def tick(self):
+        # When watching, exits are only looked for after a wakeup, with a sweep now and then in case one was missed
+        if self.selector is None or self.exits_pending or monotonic() - self.last_exit_check > EXIT_SWEEP_INTERVAL:
+            self.exits_pending = False
+            self.last_exit_check = monotonic()
+            self.collect_exits()
+
+        previous_pks = set(self.task_by_pk)
+        self.refresh_tasks()
+        if self.last_lease_update is None or monotonic() - self.last_lease_update > LEASE_RENEW_INTERVAL or previous_pks != set(self.task_by_pk):
+            self.update_leases()
+        current_tasks = {task for pk, task in self.task_by_pk.items() if pk in self.owned_pks}
+
+        # Create processes for the tasks that are due
+        now = timezone.now()
+        due = {}
+        while self._queue and self._queue[0][0] <= now:
+            _, pk = heapq.heappop(self._queue)
+            task = self.task_by_pk.get(pk)
+            if task is None or pk not in self.owned_pks or task in self.process_by_task or task in self.stopping:
+                continue
+            due[pk] = task
+        self.admit(list(due.values()), now)
+
+        if self.last_reap_check is None or monotonic() - self.last_reap_check > REAP_CHECK_INTERVAL:
+            self.reap(now)
+
+        # Shut down processes for tasks that have been disabled/deleted
+        for task in list(self.process_by_task.keys()):
+            if task not in current_tasks:
+                print('Removed', task, self.process_by_task[task].pid)
+                self.stop(task)
+
+        for task, (process, deadline, escalation) in list(self.stopping.items()):
+            if process.poll() is not None:
+                del self.stopping[task]
+                self.released.discard(task)
+                self.close_channel(task)
+                self.record_process_usage(task, process)
+                self.record_reap(task, process)
+                if task.pk in self.task_by_pk:
+                    heapq.heappush(self._queue, (self.spawn_time(task), task.pk))
+            elif deadline is not None and monotonic() > deadline:
+                if escalation == 'terminate':
+                    print('Shutdown timeout hit, terminating', task, process.pid)
+                    process.terminate()
+                    self.stopping[task] = (process, monotonic() + SHUTDOWN_TIMEOUT.total_seconds(), 'kill')
+                else:
+                    print('Terminate timeout hit, killing', task, process.pid)
+                    process.kill()
+                    self.stopping[task] = (process, None, None)
+
+        if self.log_sweeper.due():
+            self.sweep()
+
+    def stop(self, task):
+        # Ask nicely first if we can. The task is started again when the process has exited, if it's still enabled.
+        process = self.process_by_task.pop(task)
+        channel = self.channel_by_task.get(task)
+        if channel is not None:
+            channel.shutdown()
+            self.stopping[task] = (process, monotonic() + SHUTDOWN_TIMEOUT.total_seconds(), 'terminate')
+        else:
+            process.terminate()
+            self.stopping[task] = (process, monotonic() + SHUTDOWN_TIMEOUT.total_seconds(), 'kill')
+
+    def reap(self, now):
+        # A worker that hangs keeps its lock, its connections and maybe a core. Workers check their lock on heartbeat() while they run.
+        self.last_reap_check = monotonic()
+        limited = {task.pk: task for task in self.process_by_task if task.max_runtime is not None or task.heartbeat_timeout is not None}
+        if not limited:
+            return
+
+        last_checked_by_pk = dict(Task.objects.filter(pk__in=limited).values_list('pk', 'last_checked'))
+        # The log of a run that is in progress doesn't have an exit reason yet
+        runs_by_pk = {
+            pk: (started, last_run)
+            for pk, started, last_run in Log.objects.filter(task__in=limited)
+            .values('task').annotate(started=Max('execution_time', filter=Q(exit_reason='')), last_run=Max('execution_time'))
+            .values_list('task', 'started', 'last_run')
+        }
+
+        for pk, task in limited.items():
+            process = self.process_by_task[task]
+            reason = None
+            run_started, last_run = runs_by_pk.get(pk, (None, None))
+            if run_started is not None and run_started < process.started:
+                run_started = None
+            if task.max_runtime is not None and run_started is not None and now - run_started > task.max_runtime:
+                reason = 'max runtime'
+            elif task.heartbeat_timeout is not None:
+                # Workers don't heartbeat while they sleep between runs, so the timeout is for runs, and for workers that haven't started their first run
+                if run_started is not None:
+                    alive_since = run_started
+                elif last_run is None or last_run < process.started:
+                    alive_since = process.started
+                else:
+                    alive_since = None
+                last_checked = last_checked_by_pk.get(pk)
+                if alive_since is not None and last_checked is not None:
+                    alive_since = max(alive_since, last_checked)
+                # The heartbeat is only written every few seconds
+                if alive_since is not None and now - alive_since > max(task.heartbeat_timeout, MIN_HEARTBEAT_TIMEOUT):
+                    reason = 'heartbeat timeout'
+            if reason is None:
+                continue
+
+            print('Reaping', task, process.pid, f'({reason})')
+            del self.process_by_task[task]
+            self.reap_reason_by_task[task] = reason
+            process.terminate()
+            self.stopping[task] = (process, monotonic() + SHUTDOWN_TIMEOUT.total_seconds(), 'kill')
+
+    def admit(self, due, now):
+        # Over the worker limit, tasks whose slot has passed go first. Then the highest priority, then the task that is furthest behind.
+        due.sort(key=lambda task: self.admission_order(task, now))
+        free = len(due) if self.max_workers is None else max(self.max_workers - len(self.process_by_task) - len(self.stopping), 0)
+        for task in due[:free]:
+            process = self.process_by_task[task] = self.spawn(task)
+            process.started = now
+            print('Starting', task)
+
+        waiting = due[free:]
+        if not waiting:
+            return
+
+        # Try again next tick
+        retry = now + timedelta(seconds=self.poll_interval)
+        for task in waiting:
+            heapq.heappush(self._queue, (retry, task.pk))
+
+        # Workers sleep between runs, and hold on to their slot while doing so. Ask workers that aren't needed before a waiting task to make room, the least important first. They exit before their next run.
+        candidates = sorted(
+            (task for task in self.process_by_task if task not in self.released and task in self.channel_by_task),
+            key=lambda task: (task.priority, -(task.next_execution_time or now).timestamp()),
+        )
+        for task in waiting:
+            slot = task.next_execution_time or now
+            if slot > now:
+                break
+            for candidate in candidates:
+                # Only workers that are sleeping until a later slot
+                if candidate.next_execution_time is not None and candidate.next_execution_time > max(slot, now):
+                    candidates.remove(candidate)
+                    self.channel_by_task[candidate].release()
+                    self.released.add(candidate)
+                    break
+
+    @staticmethod
+    def admission_order(task, now):
+        next_execution_time = task.next_execution_time or now
+        return next_execution_time > now, -task.priority, next_execution_time
+
+    def sweep(self):
+        # The sweep runs in the tick, so it only does a bounded amount of work at a time
+        result = self.log_sweeper.sweep()
+        if result['logs']:
+            print('Swept {logs} logs with {chunks} chunks of output in {seconds:.3f}s'.format(**result))
+
+    def run(self):
+        # noinspection PyUnusedLocal
+        def sigterm_handler(signum, frame):
+            self.running = False
+
+        signal.signal(signal.SIGTERM, sigterm_handler)
+
+        if self.fork_server:
+            # Import all task modules once, so forked workers start warm
+            get_tasks()
+
+        self.watch()
+        try:
+            while self.running:
+                self.tick()
+                close_old_connections()
+                # Sleep until the next spawn is due, but check for changes to the tasks regularly. Exits of workers and SIGTERM wake us up right away.
+                time_to_next_spawn = self.time_to_next_spawn()
+                if time_to_next_spawn is None:
+                    self.wait(self.poll_interval)
+                else:
+                    self.wait(max(0, min(self.poll_interval, time_to_next_spawn)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.unwatch()
+
+        print('Shutting down')
+        for task, process in self.process_by_task.items():
+            print('Killed', task, process.pid)
+            process.terminate()
+        for task, (process, _, _) in self.stopping.items():
+            process.terminate()
+        for thread_worker in self.thread_workers.values():
+            thread_worker.process.terminate()
+        self.wait_for_workers()
+        for thread_worker in self.thread_workers.values():
+            thread_worker.close()
+        self.release_leases()
+
+    def wait_for_workers(self):
+        # The leases are kept until the workers have exited, so that another node doesn't start their tasks while they are still running
+        process_by_task = {**self.process_by_task, **{task: process for task, (process, _, _) in self.stopping.items()}}
+        processes = [process for process in process_by_task.values() if not isinstance(process, ThreadHandle)]
+        processes += [thread_worker.process for thread_worker in self.thread_workers.values()]
+        deadline = monotonic() + SHUTDOWN_TIMEOUT.total_seconds()
+        while any(process.poll() is None for process in processes) and monotonic() < deadline:
+            sleep(0.1)
+        for process in processes:
+            if process.poll() is None:
+                print('Terminate timeout hit, killing', process.pid)
+                process.kill()
+        deadline = monotonic() + 1
+        while any(process.poll() is None for process in processes) and monotonic() < deadline:
+            sleep(0.01)
+        for task, process in process_by_task.items():
+            self.clear_lock(task, process)
@@ -0,0 +1,557 @@
+import os
+import signal
+import sys
+from datetime import timedelta
+from socket import gethostname
+from threading import (
+    Event,
+    Thread,
+)
+from time import (
+    monotonic,
+    sleep,
+)
+from unittest import mock
+from uuid import uuid4
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import (
+    connection,
+    transaction,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import urd
+from urd import (
+    SHUTDOWN_EXIT_CODE,
+    ShuttingDown,
+)
+from urd.models import (
+    Log,
+    Task,
+)
+from urd.monitor import (
+    ForkedProcess,
+    Monitor,
+    parse_environments,
+    ThreadWorker,
+)
+from urd.worker import worker
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def test_parse_environments():
+    assert parse_environments('Prod, test') == {'prod', 'test'}
+
+
+def test_refresh_tasks_only_rebuilds_on_change():
+    t = Task.objects.create(name='a', function='a', interval=timedelta(seconds=1), environment='test')
+    Task.objects.create(name='b', function='b', interval=timedelta(seconds=1), environment='other')
+
+    monitor = Monitor('test')
+    assert monitor.refresh_tasks()
+    assert list(monitor.task_by_pk) == [t.pk]
+
+    with CaptureQueriesContext(connection) as queries:
+        assert not monitor.refresh_tasks()
+    assert len(queries) == 1
+
+    next_execution_time = timezone.now()
+    Task.objects.filter(pk=t.pk).update(next_execution_time=next_execution_time)
+    with CaptureQueriesContext(connection) as queries:
+        assert monitor.refresh_tasks()
+    assert len(queries) == 1
+    assert monitor.task_by_pk[t.pk].next_execution_time == next_execution_time
+
+    t.disable()
+    assert monitor.refresh_tasks()
+    assert monitor.task_by_pk == {}
+
+    t.enable()
+    assert monitor.refresh_tasks()
+    assert list(monitor.task_by_pk) == [t.pk]
+
+
+def test_monitor_clears_the_lock_of_exited_workers():
+    task = Task.objects.create(name='a', function='a', interval=timedelta(hours=1), environment='test', pid=123, host=gethostname(), current_run_id=uuid4())
+    monitor = Monitor('test')
+    process = mock.Mock(pid=123, started=timezone.now())
+    process.poll.return_value = urd.SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
+    monitor.process_by_task[task] = process
+    monitor.collect_exits()
+    task.refresh_from_db()
+    assert (task.pid, task.current_run_id) == (None, None)
+
+
+def test_monitor_keeps_its_leases_until_the_workers_have_exited():
+    task = Task.objects.create(name='a', function='a', interval=timedelta(hours=1), environment='test')
+
+    def ignore_sigterm():
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        sleep(60)
+
+    monitor = Monitor('test')
+    monitor.refresh_tasks()
+    monitor.update_leases()
+    with mock.patch('urd.monitor.connections'):
+        process = ForkedProcess(ignore_sigterm)
+    Task.objects.filter(pk=task.pk).update(pid=process.pid, host=gethostname())
+    monitor.process_by_task[task] = process
+    sleep(0.1)
+    process.terminate()
+
+    with mock.patch('urd.monitor.SHUTDOWN_TIMEOUT', timedelta(seconds=0.2)):
+        monitor.wait_for_workers()
+    assert process.returncode == -signal.SIGKILL
+
+    task.refresh_from_db()
+    assert (task.pid, task.owner) == (None, monitor.node)
+
+
+def test_changing_the_execution_mode_restarts_the_worker():
+    task = Task.objects.create(name='a', function='a', interval=timedelta(seconds=1), environment='test')
+    monitor = Monitor('test')
+    channel = mock.Mock()
+    processes = []
+
+    def spawn(t):
+        process = mock.Mock(pid=len(processes))
+        process.poll.return_value = None
+        process.execution_mode = t.execution_mode
+        processes.append(process)
+        monitor.channel_by_task[t] = channel
+        return process
+
+    with mock.patch.object(monitor, 'spawn', new=spawn):
+        monitor.tick()
+        assert [p.execution_mode for p in processes] == ['process']
+
+        Task.objects.filter(pk=task.pk).update(execution_mode='thread')
+        monitor.tick()
+        channel.shutdown.assert_called_once_with()
+        assert task in monitor.stopping
+        assert len(processes) == 1
+
+        processes[0].poll.return_value = urd.SHUTDOWN_EXIT_CODE
+        monitor.tick()
+        assert task not in monitor.stopping
+        monitor.tick()
+        assert [p.execution_mode for p in processes] == ['process', 'thread']
+        assert monitor.process_by_task == {task: processes[1]}
+
+        # Other changes don't restart it
+        Task.objects.filter(pk=task.pk).update(priority=5)
+        monitor.tick()
+        channel.shutdown.assert_called_once_with()
+        assert monitor.stopping == {}
+
+
+def test_tick_starts_and_removes_processes():
+    t = Task.objects.create(name='a', function='a', interval=timedelta(seconds=1), environment='test')
+
+    monitor = Monitor('test')
+    process = mock.Mock(pid=123)
+    process.poll.return_value = None
+    with mock.patch.object(monitor, 'spawn', return_value=process):
+        monitor.tick()
+    assert monitor.process_by_task == {t: process}
+
+    t.disable()
+    monitor.tick()
+    process.terminate.assert_called_once()
+
+
+def test_forked_process():
+    with mock.patch('urd.monitor.connections'):
+        process = ForkedProcess(lambda: 8)
+    while process.poll() is None:
+        sleep(0.01)
+    assert process.returncode == 8
+
+
+def test_thread_tasks_share_a_worker_process():
+    a = Task.objects.create(name='a', function='a', interval=timedelta(seconds=1), environment='test', execution_mode='thread')
+    b = Task.objects.create(name='b', function='b', interval=timedelta(seconds=1), environment='test', execution_mode='thread')
+
+    monitor = Monitor('test')
+    process = mock.Mock(pid=123)
+    process.poll.return_value = None
+    channel = mock.Mock()
+    status_read_fd, status_write_fd = os.pipe()
+    os.set_blocking(status_read_fd, False)
+    thread_worker = ThreadWorker(process, channel, status_read_fd)
+    with mock.patch.object(monitor, 'spawn_thread_worker', return_value=thread_worker) as spawn_thread_worker:
+        monitor.tick()
+    spawn_thread_worker.assert_called_once()
+    assert set(monitor.process_by_task) == {a, b}
+    channel.send.assert_has_calls([mock.call('run', str(a.pk)), mock.call('run', str(b.pk))], any_order=True)
+
+    Task.objects.filter(pk=a.pk).update(next_execution_time=timezone.now() + timedelta(hours=1))
+    os.write(status_write_fd, f'exited {a.pk} 8\n'.encode())
+    monitor.tick()
+    assert set(monitor.process_by_task) == {b}
+
+    # Disabling a thread task only stops its thread
+    b.disable()
+    monitor.tick()
+    channel.send.assert_called_with('shutdown', str(b.pk))
+    process.terminate.assert_not_called()
+
+    os.close(status_write_fd)
+    thread_worker.close()
+
+
+def test_worker_process_usage_is_recorded_on_its_last_run():
+    task = Task.objects.create(name='a', function='a', interval=timedelta(seconds=1), environment='test')
+    before = Log.objects.create(task=task, execution_time=timezone.now() - timedelta(minutes=1), run_id=uuid4())
+
+    monitor = Monitor('test')
+    with mock.patch('urd.monitor.connections'):
+        process = ForkedProcess(lambda: sum(range(100000)) and 8)
+    process.started = timezone.now() - timedelta(seconds=1)
+    logs = [Log.objects.create(task=task, execution_time=timezone.now(), run_id=uuid4()) for _ in range(2)]
+    while process.poll() is None:
+        sleep(0.01)
+
+    monitor.record_process_usage(task, process)
+    assert [log.pk for log in Log.objects.filter(process_usage__isnull=False)] == [logs[-1].pk]
+    assert Log.objects.get(pk=logs[-1].pk).process_usage['max_rss'] > 0
+    assert Log.objects.get(pk=before.pk).process_usage is None
+
+
+def test_tick_only_spawns_due_tasks():
+    due = Task.objects.create(name='due', function='a', interval=timedelta(days=1), environment='test', next_execution_time=timezone.now() + timedelta(seconds=1))
+    Task.objects.create(name='later', function='a', interval=timedelta(days=1), environment='test', next_execution_time=timezone.now() + timedelta(hours=1))
+
+    monitor = Monitor('test')
+    process = mock.Mock(pid=123)
+    process.poll.return_value = None
+    with mock.patch.object(monitor, 'spawn', return_value=process) as spawn:
+        monitor.tick()
+        monitor.tick()
+    spawn.assert_called_once_with(due)
+    assert 3580 < monitor.time_to_next_spawn() <= 3590
+
+    # When the process exits, the task is queued again
+    process.poll.return_value = 0
+    with mock.patch.object(monitor, 'spawn', return_value=process) as spawn:
+        monitor.tick()
+    spawn.assert_called_once_with(due)
+
+
+def test_tasks_are_shared_between_nodes(settings):
+    tasks = [Task.objects.create(name=str(i), function='a', interval=timedelta(days=1), environment='test', next_execution_time=timezone.now() + timedelta(hours=1)) for i in range(4)]
+
+    settings.URD_NODE_NAME = 'a'
+    a = Monitor('test')
+    a.tick()
+    assert a.owned_pks == {t.pk for t in tasks}
+
+    settings.URD_NODE_NAME = 'b'
+    b = Monitor('test')
+    b.tick()
+    assert b.owned_pks == set()
+
+    # a gives back its share of idle tasks, and b picks them up
+    a.update_leases()
+    b.update_leases()
+    assert len(a.owned_pks) == len(b.owned_pks) == 2
+    assert a.owned_pks.isdisjoint(b.owned_pks)
+
+
+def test_leases_of_dead_nodes_are_taken_over(settings):
+    task = Task.objects.create(name='a', function='a', interval=timedelta(days=1), environment='test', pid=123)
+
+    settings.URD_NODE_NAME = 'a'
+    a = Monitor('test')
+    a.refresh_tasks()
+    a.update_leases()
+    assert a.owned_pks == {task.pk}
+
+    settings.URD_NODE_NAME = 'b'
+    b = Monitor('test')
+    b.refresh_tasks()
+    b.update_leases()
+    assert b.owned_pks == set()
+
+    # a stops renewing its leases
+    Task.objects.update(lease_expires=timezone.now() - timedelta(seconds=1))
+    b.update_leases()
+    assert b.owned_pks == {task.pk}
+    # The worker that might still be running on a is told to shut down
+    assert Task.objects.get(pk=task.pk).shutdown_command is not None
+
+
+def test_worker_limit_admits_by_priority_then_lag(settings):
+    settings.URD_MAX_WORKERS = 5
+    settings.URD_MAX_WORKERS_BY_ENVIRONMENT = dict(test=2)
+    now = timezone.now()
+    low = Task.objects.create(name='low', function='a', interval=timedelta(hours=1), environment='test', next_execution_time=now - timedelta(minutes=5))
+    high = Task.objects.create(name='high', function='a', interval=timedelta(hours=1), environment='test', next_execution_time=now, priority=10)
+    behind = Task.objects.create(name='behind', function='a', interval=timedelta(hours=1), environment='test', next_execution_time=now - timedelta(minutes=10))
+    on_time = Task.objects.create(name='on time', function='a', interval=timedelta(hours=1), environment='test', next_execution_time=now - timedelta(minutes=1))
+
+    monitor = Monitor('test')
+    assert monitor.max_workers == 2
+    processes = {}
+    channels = {}
+
+    def spawn(task):
+        process = processes[task.name] = mock.Mock(pid=123)
+        process.poll.return_value = None
+        monitor.channel_by_task[task] = channels[task.name] = mock.Mock()
+        return process
+
+    with mock.patch.object(monitor, 'spawn', new=spawn):
+        monitor.tick()
+        assert {task.name for task in monitor.process_by_task} == {'high', 'behind'}
+        # Both are about to run, so neither is asked to make room
+        channels['high'].release.assert_not_called()
+        channels['behind'].release.assert_not_called()
+
+        processes['behind'].poll.return_value = 8
+        Task.objects.filter(pk=behind.pk).update(next_execution_time=now + timedelta(hours=1))
+        sleep(monitor.poll_interval)
+        monitor.tick()
+        assert {task.name for task in monitor.process_by_task} == {'high', 'low'}
+
+        # Once the high priority task has run, its worker sleeps until the next slot. It is asked to make room for the waiting task.
+        Task.objects.filter(pk=high.pk).update(next_execution_time=now + timedelta(hours=1))
+        sleep(monitor.poll_interval)
+        monitor.tick()
+        channels['high'].release.assert_called_once()
+        channels['low'].release.assert_not_called()
+
+
+def test_hung_worker_is_terminated_then_killed():
+    now = timezone.now()
+    task = Task.objects.create(name='a', function='a', interval=timedelta(hours=1), environment='test', next_execution_time=now + timedelta(hours=1), heartbeat_timeout=timedelta(seconds=30))
+
+    def hang():
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        sleep(60)
+
+    with mock.patch('urd.monitor.connections'):
+        process = ForkedProcess(hang)
+    process.started = now - timedelta(minutes=1)
+    Task.objects.filter(pk=task.pk).update(pid=process.pid, host=gethostname(), current_run_id=uuid4(), last_checked=now - timedelta(seconds=20))
+    log = Log.objects.create(task=task, execution_time=now - timedelta(seconds=50), run_id=uuid4())
+
+    monitor = Monitor('test')
+    monitor.refresh_tasks()
+    monitor.process_by_task[task] = process
+
+    # Still within the timeout
+    monitor.reap(now)
+    assert monitor.process_by_task == {task: process}
+
+    Task.objects.filter(pk=task.pk).update(last_checked=now - timedelta(minutes=1))
+    with mock.patch('urd.monitor.SHUTDOWN_TIMEOUT', timedelta()):
+        monitor.reap(now)
+        assert monitor.process_by_task == {}
+        assert monitor.stopping[task][2] == 'kill'
+
+        # SIGTERM is ignored, so it takes a SIGKILL
+        while task in monitor.stopping:
+            monitor.tick()
+            sleep(0.01)
+
+    assert process.returncode == -signal.SIGKILL
+    assert Log.objects.get(pk=log.pk).exit_reason == 'heartbeat timeout'
+    task.refresh_from_db()
+    assert (task.pid, task.current_run_id) == (None, None)
+
+
+def function_in_a_long_transaction(heartbeat):
+    # SQLite only has one writer at a time, so this transaction only reads
+    with transaction.atomic():
+        User.objects.exists()
+        while not transaction_done.is_set():
+            heartbeat()
+            sleep(0.01)
+    raise ShuttingDown()
+
+
+transaction_done = Event()
+
+
+def test_heartbeats_in_a_transaction_are_seen_by_the_monitor():
+    task = Task.objects.create(
+        name='a',
+        function='urd.monitor__tests.function_in_a_long_transaction',
+        interval=timedelta(hours=1),
+        environment='test',
+        heartbeat_timeout=timedelta(seconds=0.3),
+    )
+    monitor = Monitor('test')
+    monitor.refresh_tasks()
+    process = mock.Mock(pid=123, started=timezone.now())
+    process.poll.return_value = None
+    monitor.process_by_task[task] = process
+
+    transaction_done.clear()
+    with mock.patch('urd.models.HEARTBEAT_INTERVAL', timedelta(seconds=0.05)), \
+         mock.patch('urd.monitor.MIN_HEARTBEAT_TIMEOUT', timedelta()):
+        thread = Thread(target=worker, args=(Task.objects.get(pk=task.pk),))
+        thread.start()
+        try:
+            # The run takes longer than the timeout, but keeps heartbeating
+            for _ in range(10):
+                sleep(0.1)
+                monitor.reap(timezone.now())
+            assert monitor.process_by_task == {task: process}
+        finally:
+            transaction_done.set()
+            thread.join()
+
+    process.terminate.assert_not_called()
+    assert Log.objects.get(task=task).heartbeat_count > 10
+
+
+def test_heartbeat_timeout_has_a_minimum():
+    field = Task._meta.get_field('heartbeat_timeout')
+    with pytest.raises(ValidationError):
+        field.run_validators(timedelta(seconds=1))
+    field.run_validators(urd.MIN_HEARTBEAT_TIMEOUT)
+
+
+def test_run_over_max_runtime_is_reaped():
+    now = timezone.now()
+    task = Task.objects.create(name='a', function='a', interval=timedelta(hours=1), environment='test', max_runtime=timedelta(minutes=1))
+    monitor = Monitor('test')
+    monitor.refresh_tasks()
+    process = mock.Mock(pid=123, started=now - timedelta(minutes=5))
+    process.poll.return_value = None
+    monitor.process_by_task[task] = process
+
+    # A run that was left behind by an earlier worker doesn't count
+    Log.objects.create(task=task, execution_time=now - timedelta(minutes=10), run_id=uuid4())
+    monitor.reap(now)
+    process.terminate.assert_not_called()
+
+    log = Log.objects.create(task=task, execution_time=now - timedelta(seconds=30), run_id=uuid4())
+    monitor.reap(now)
+    process.terminate.assert_not_called()
+
+    monitor.reap(now + timedelta(minutes=1))
+    process.terminate.assert_called_once()
+    process.poll.return_value = -signal.SIGTERM
+    with mock.patch.object(monitor, 'spawn', return_value=mock.Mock(pid=456)):
+        monitor.tick()
+    assert Log.objects.get(pk=log.pk).exit_reason == 'max runtime'
+
+
+@pytest.mark.parametrize('target, exit_code', [
+    (lambda: None, 0),
+    (lambda: 8, 8),
+    (lambda: sys.exit(), 0),
+    (lambda: sys.exit(3), 3),
+    (lambda: sys.exit('message'), 1),
+    (lambda: 1 / 0, SHUTDOWN_EXIT_CODE),
+])
+def test_forked_process_exit_code(target, exit_code):
+    with mock.patch('urd.monitor.connections'):
+        process = ForkedProcess(target)
+    while process.poll() is None:
+        sleep(0.01)
+    assert process.returncode == exit_code
+
+
+def test_exits_wake_up_the_monitor():
+    monitor = Monitor('test')
+    monitor.watch()
+    try:
+        monitor.exits_pending = False
+        start = monotonic()
+        monitor.wait(0.05)
+        assert not monitor.exits_pending
+        assert monotonic() - start >= 0.05
+
+        # SIGCHLD
+        with mock.patch('urd.monitor.connections'):
+            process = ForkedProcess(lambda: 8)
+        start = monotonic()
+        monitor.wait(5)
+        assert monitor.exits_pending
+        assert monotonic() - start < 1
+        assert process.poll() == 8
+
+        # A report from a thread worker
+        monitor.exits_pending = False
+        read_fd, write_fd = os.pipe()
+        monitor.thread_workers[0] = mock.Mock(status_fd=read_fd)
+        os.write(write_fd, b'exited 1 8\n')
+        monitor.wait(5)
+        assert monitor.exits_pending
+        os.close(read_fd)
+        os.close(write_fd)
+    finally:
+        monitor.unwatch()
+    assert signal.getsignal(signal.SIGCHLD) == signal.SIG_DFL
+
+
+def test_tick_only_looks_for_exits_after_a_wakeup():
+    t = Task.objects.create(name='a', function='a', interval=timedelta(hours=1), environment='test', next_execution_time=timezone.now() + timedelta(hours=1))
+    monitor = Monitor('test')
+    process = mock.Mock(pid=123)
+    process.poll.return_value = None
+    monitor.watch()
+    try:
+        monitor.tick()
+        monitor.process_by_task[monitor.task_by_pk[t.pk]] = process
+        monitor.tick()
+        process.poll.assert_not_called()
+
+        monitor.exits_pending = True
+        monitor.tick()
+        process.poll.assert_called_once()
+    finally:
+        monitor.unwatch()
+
+
+def test_crash_loops_are_throttled():
+    # The function can't be imported, so every worker crashes right away
+    task = Task.objects.create(name='a', function='does_not_exist.function', interval=timedelta(seconds=1), environment='test')
+    monitor = Monitor('test')
+    processes = []
+
+    def spawn(task):
+        process = mock.Mock(pid=123)
+        process.poll.return_value = worker(Task.objects.get(pk=task.pk))
+        processes.append(process)
+        return process
+
+    def tick():
+        spawned = len(processes)
+        with mock.patch.object(monitor, 'spawn', side_effect=spawn):
+            monitor.tick()
+        return len(processes) > spawned
+
+    with mock.patch('urd.monitor.CRASH_BACKOFF', timedelta(milliseconds=100)), \
+         mock.patch('urd.models.sleep'):
+        assert tick()
+        # A crash or two is just started again
+        assert tick()
+        assert tick()
+        task.refresh_from_db()
+        assert (task.crash_count, task.crash_backoff_until) == (2, None)
+
+        assert not tick()
+        task.refresh_from_db()
+        assert task.crash_count == 3
+        assert 0.04 <= (task.crash_backoff_until - timezone.now()).total_seconds() <= 0.1
+
+        sleep(0.1)
+        assert tick()
+        assert {log.exit_reason for log in task.logs.all()} == {'error'}
+        assert task.logs.count() == 4
+
+        # Exiting to wait for the next execution means the worker is fine again
+        processes[-1].poll.return_value = urd.SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
+        monitor.collect_exits()
+    task.refresh_from_db()
+    assert (task.crash_count, task.crash_backoff_until) == (0, None)
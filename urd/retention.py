@@ -0,0 +1,164 @@
+from time import monotonic
+
+from django.conf import settings
+from django.db.models import (
+    Count,
+    Max,
+    Sum,
+)
+from django.db.models.functions import Length
+from django.utils import timezone
+
+from urd import (
+    KEEP_LOGS,
+    LOG_SWEEP_BATCH_SIZE,
+    LOG_SWEEP_INTERVAL,
+    LOG_SWEEP_PAUSE,
+    LOG_SWEEP_TASKS,
+)
+from urd.models import (
+    Log,
+    LogChunk,
+    Task,
+)
+
+
+def _retention_settings(keep, max_age, max_bytes):
+    if keep is None:
+        keep = getattr(settings, 'URD_KEEP_LOGS', KEEP_LOGS)
+    if max_age is None:
+        max_age = getattr(settings, 'URD_LOG_MAX_AGE', None)
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'URD_LOG_MAX_BYTES', None)
+    # The newest log of a task is never deleted, since the task might still be writing to it
+    return max(keep, 1), max_age, max_bytes
+
+
+def _newest(logs):
+    return set(logs.values('task_id').annotate(newest=Max('pk')).values_list('newest', flat=True))
+
+
+def _over_count_or_age(logs, keep, max_age):
+    newest = _newest(logs)
+    to_delete = set()
+    for task_id in logs.values('task_id').annotate(count=Count('pk')).filter(count__gt=keep).values_list('task_id', flat=True):
+        to_delete.update(Log.objects.filter(task_id=task_id).order_by('-pk').values_list('pk', flat=True)[keep:])
+
+    if max_age is not None:
+        to_delete.update(pk for pk in logs.filter(execution_time__lt=timezone.now() - max_age).values_list('pk', flat=True) if pk not in newest)
+
+    return to_delete
+
+
+def _sizes(log_ids):
+    # Compressed size, as stored
+    size_by_log_id = dict(LogChunk.objects.filter(log_id__in=log_ids).order_by().values('log_id').annotate(size=Sum(Length('data'))).values_list('log_id', 'size'))
+    return [(log_id, size_by_log_id.get(log_id) or 0) for log_id in log_ids]
+
+
+def _delete(to_delete, batch_size):
+    logs = chunks = 0
+    to_delete = sorted(to_delete)
+    for i in range(0, len(to_delete), batch_size):
+        _, deleted = Log.objects.filter(pk__in=to_delete[i:i + batch_size]).delete()
+        logs += deleted.get(Log._meta.label, 0)
+        chunks += deleted.get(LogChunk._meta.label, 0)
+    return logs, chunks
+
+
+def sweep_logs(keep=None, max_age=None, max_bytes=None, batch_size=LOG_SWEEP_BATCH_SIZE):
+    # Sweeps all logs at once. The monitor uses LogSweeper instead, which does a little at a time.
+    start = monotonic()
+    keep, max_age, max_bytes = _retention_settings(keep, max_age, max_bytes)
+
+    to_delete = _over_count_or_age(Log.objects.all(), keep, max_age)
+
+    if max_bytes is not None:
+        newest = _newest(Log.objects.all())
+        sizes = _sizes(list(Log.objects.order_by('pk').values_list('pk', flat=True)))
+        total = sum(size for log_id, size in sizes if log_id not in to_delete)
+        for log_id, size in sizes:
+            if total <= max_bytes:
+                break
+            if log_id in to_delete or log_id in newest:
+                continue
+            to_delete.add(log_id)
+            total -= size
+
+    logs, chunks = _delete(to_delete, batch_size)
+    return dict(
+        logs=logs,
+        chunks=chunks,
+        seconds=monotonic() - start,
+    )
+
+
+class LogSweeper:
+    # A round of sweeping goes through the tasks by id, `tasks_per_call` at a time, for the count and age limits. With URD_LOG_MAX_BYTES it then goes through the logs by id, `logs_per_call` at a time: first to add up their size, then to delete the oldest until the total is under the limit. So every call only looks at a bounded number of rows.
+    def __init__(self, tasks_per_call=LOG_SWEEP_TASKS, logs_per_call=LOG_SWEEP_BATCH_SIZE):
+        self.tasks_per_call = tasks_per_call
+        self.logs_per_call = logs_per_call
+        self.round_started = None
+        self.last_call = None
+        self.after_task_id = None
+        self.after_log_id = None
+        self.total_bytes = 0
+        self.excess_bytes = None
+
+    @property
+    def in_round(self):
+        return self.after_task_id is not None or self.after_log_id is not None
+
+    def due(self):
+        if self.round_started is None:
+            return True
+        if self.in_round:
+            return monotonic() - self.last_call >= LOG_SWEEP_PAUSE
+        return monotonic() - self.round_started >= LOG_SWEEP_INTERVAL
+
+    def sweep(self, keep=None, max_age=None, max_bytes=None):
+        start = monotonic()
+        keep, max_age, max_bytes = _retention_settings(keep, max_age, max_bytes)
+        if not self.in_round:
+            self.round_started = start
+            self.after_task_id = 0
+            if max_bytes is not None:
+                self.after_log_id = 0
+                self.total_bytes = 0
+                self.excess_bytes = None
+        self.last_call = start
+
+        to_delete = set()
+        if self.after_task_id is not None:
+            task_ids = list(Task.objects.filter(pk__gt=self.after_task_id).order_by('pk').values_list('pk', flat=True)[:self.tasks_per_call])
+            to_delete = _over_count_or_age(Log.objects.filter(task_id__in=task_ids), keep, max_age)
+            self.after_task_id = task_ids[-1] if len(task_ids) == self.tasks_per_call else None
+        elif self.excess_bytes is None:
+            sizes = _sizes(list(Log.objects.filter(pk__gt=self.after_log_id).order_by('pk').values_list('pk', flat=True)[:self.logs_per_call]))
+            self.total_bytes += sum(size for _, size in sizes)
+            if len(sizes) == self.logs_per_call:
+                self.after_log_id = sizes[-1][0]
+            else:
+                self.excess_bytes = self.total_bytes - max_bytes
+                self.after_log_id = 0 if self.excess_bytes > 0 else None
+        else:
+            logs = list(Log.objects.filter(pk__gt=self.after_log_id).order_by('pk').values_list('pk', 'task_id')[:self.logs_per_call])
+            sizes = _sizes([pk for pk, _ in logs])
+            newest = _newest(Log.objects.filter(task_id__in={task_id for _, task_id in logs}))
+            for log_id, size in sizes:
+                if self.excess_bytes <= 0:
+                    break
+                if log_id not in newest:
+                    to_delete.add(log_id)
+                    self.excess_bytes -= size
+            if self.excess_bytes <= 0 or len(sizes) < self.logs_per_call:
+                self.after_log_id = None
+            else:
+                self.after_log_id = sizes[-1][0]
+
+        logs, chunks = _delete(to_delete, self.logs_per_call)
+        return dict(
+            logs=logs,
+            chunks=chunks,
+            seconds=monotonic() - start,
+        )
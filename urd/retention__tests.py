@@ -0,0 +1,96 @@
+from datetime import timedelta
+from uuid import uuid4
+
+import pytest
+from django.utils import timezone
+
+from urd.models import (
+    Log,
+    LogChunk,
+    Task,
+)
+from urd.retention import (
+    LogSweeper,
+    sweep_logs,
+)
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def create_logs(task, count, data=b'x', execution_time=None):
+    logs = []
+    for _ in range(count):
+        log = Log.objects.create(task=task, execution_time=execution_time or timezone.now(), run_id=uuid4())
+        LogChunk.objects.create(log=log, line_count=1, data=data)
+        logs.append(log)
+    return logs
+
+
+def test_sweep_by_count():
+    a = Task.objects.create(name='a', interval=timedelta(seconds=1))
+    b = Task.objects.create(name='b', interval=timedelta(seconds=1))
+    a_logs = create_logs(a, 5)
+    b_logs = create_logs(b, 2)
+
+    result = sweep_logs(keep=3, batch_size=1)
+    assert result['logs'] == 2
+    assert result['chunks'] == 2
+
+    assert list(Log.objects.filter(task=a)) == a_logs[2:]
+    assert list(Log.objects.filter(task=b)) == b_logs
+
+
+def test_sweep_by_age_keeps_newest():
+    a = Task.objects.create(name='a', interval=timedelta(seconds=1))
+    logs = create_logs(a, 3, execution_time=timezone.now() - timedelta(days=2))
+
+    assert sweep_logs(max_age=timedelta(days=1))['logs'] == 2
+    assert list(Log.objects.all()) == logs[-1:]
+
+
+def test_sweep_by_size():
+    a = Task.objects.create(name='a', interval=timedelta(seconds=1))
+    logs = create_logs(a, 4, data=b'x' * 10)
+
+    assert sweep_logs(max_bytes=25)['logs'] == 2
+    assert list(Log.objects.all()) == logs[2:]
+
+
+def test_log_sweeper_does_a_few_tasks_per_call():
+    a = Task.objects.create(name='a', interval=timedelta(seconds=1))
+    b = Task.objects.create(name='b', interval=timedelta(seconds=1))
+    create_logs(a, 4)
+    b_logs = create_logs(b, 4, execution_time=timezone.now() - timedelta(days=2))
+
+    sweeper = LogSweeper(tasks_per_call=1)
+    assert sweeper.due()
+    assert sweeper.sweep(keep=2, max_age=timedelta(days=1))['logs'] == 2
+    assert Log.objects.filter(task=a).count() == 2
+    assert Log.objects.filter(task=b).count() == 4
+    assert sweeper.in_round
+
+    assert sweeper.sweep(keep=2, max_age=timedelta(days=1))['logs'] == 3
+    assert list(Log.objects.filter(task=b)) == b_logs[-1:]
+
+    # An empty page of tasks ends the round, and the next one waits for LOG_SWEEP_INTERVAL
+    assert sweeper.sweep(keep=2, max_age=timedelta(days=1))['logs'] == 0
+    assert not sweeper.in_round
+    assert not sweeper.due()
+
+
+def test_log_sweeper_by_size():
+    a = Task.objects.create(name='a', interval=timedelta(seconds=1))
+    b = Task.objects.create(name='b', interval=timedelta(seconds=1))
+    a_logs = create_logs(a, 3, data=b'x' * 10)
+    b_logs = create_logs(b, 2, data=b'x' * 10)
+
+    sweeper = LogSweeper(logs_per_call=2)
+    results = []
+    while True:
+        results.append(sweeper.sweep(max_bytes=25)['logs'])
+        if not sweeper.in_round:
+            break
+
+    # One call for the tasks, three to add up the sizes, and two to delete, skipping the newest log of a
+    assert results == [0, 0, 0, 0, 2, 1]
+    assert list(Log.objects.all()) == a_logs[2:] + b_logs[1:]
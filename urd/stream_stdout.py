@@ -1,7 +1,8 @@
+import asyncio
+import inspect
 import sys
 import traceback
 from datetime import timedelta
-from importlib import import_module
 from queue import (
     Empty,
     Queue,
@@ -11,6 +12,13 @@ from threading import Thread
 from django.http.response import StreamingHttpResponse
 from django.utils.html import escape
 
+from urd import (
+    get_task_function,
+    STREAM_POLL_TIMEOUT,
+)
+
+STYLE = '<style>html { white-space: pre-wrap; } </style>'
+
 
 class Printer:
     def __init__(self):
@@ -24,6 +32,19 @@ class Printer:
     def flush(self):
         self._prev_stdout.flush()
 
+    def read(self, timeout=None):
+        # Wait for the first chunk, then coalesce everything else that is already waiting into one write
+        try:
+            chunks = [self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait()]
+        except Empty:
+            return ''
+        try:
+            while True:
+                chunks.append(self.queue.get_nowait())
+        except Empty:
+            pass
+        return ''.join(chunks)
+
     def __enter__(self):
         self._prev_stdout = sys.stdout
         sys.stdout = self
@@ -39,9 +60,7 @@ class Printer:
 
 class Streamer:
     def __init__(self, name, *args, **kwargs):
-        module_name, _, function_name = name.rpartition('.')
-        module = import_module(module_name)
-        function = getattr(module, function_name)
+        function = get_task_function(name)
         assert function._is_task
         from urd.worker import Logger
         from urd.models import Task
@@ -50,7 +69,10 @@ class Streamer:
         def run():
             try:
                 with Logger(t):
-                    function(*args, **kwargs)
+                    if inspect.iscoroutinefunction(function):
+                        asyncio.run(function(*args, **kwargs))
+                    else:
+                        function(*args, **kwargs)
             finally:
                 self.done = True
         self.done = False
@@ -59,23 +81,41 @@ class Streamer:
     def start(self):
         with Printer() as printer:
             self.thread.start()
-            yield '<style>html { white-space: pre-wrap; } </style>'
+            yield STYLE
             while not self.done:
-                try:
-                    yield escape(printer.queue.get_nowait())
-                except Empty:
-                    pass
+                chunk = printer.read(timeout=STREAM_POLL_TIMEOUT)
+                if chunk:
+                    yield escape(chunk)
 
             self.thread.join()
 
             # make sure last message is not lost
-            try:
-                while True:
-                    yield escape(printer.queue.get_nowait())
-            except Empty:
-                pass
+            chunk = printer.read()
+            if chunk:
+                yield escape(chunk)
+
+    async def astart(self):
+        with Printer() as printer:
+            self.thread.start()
+            yield STYLE
+            while not self.done:
+                chunk = await asyncio.to_thread(printer.read, timeout=STREAM_POLL_TIMEOUT)
+                if chunk:
+                    yield escape(chunk)
+
+            await asyncio.to_thread(self.thread.join)
+
+            # make sure last message is not lost
+            chunk = printer.read()
+            if chunk:
+                yield escape(chunk)
 
 
 def stream_stdout(name, *args, **kwargs):
     streamer = Streamer(name, *args, **kwargs)
     return StreamingHttpResponse(streamer.start())
+
+
+def astream_stdout(name, *args, **kwargs):
+    streamer = Streamer(name, *args, **kwargs)
+    return StreamingHttpResponse(streamer.astart())
@@ -1,7 +1,30 @@
+import math
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from time import (
+    monotonic,
+    sleep,
+)
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import (
+    F,
+    Max,
+    OuterRef,
+    Q,
+    Subquery,
+)
 from django.http import (
     Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    JsonResponse,
     StreamingHttpResponse,
 )
+from django.utils import timezone
 from django.utils.translation import gettext
 from iommi import (
     Action,
@@ -9,8 +32,23 @@ from iommi import (
     Table,
 )
 
-from urd import get_tasks
-from urd.stream_stdout import stream_stdout
+from urd import (
+    get_tasks,
+    METRICS_LAG_RUNS,
+    TAIL_CACHE_TIMEOUT,
+    TAIL_MAX_WAITERS,
+    TAIL_POLL_INTERVAL,
+    TAIL_TIMEOUT,
+)
+from urd.models import (
+    Log,
+    LogChunk,
+    Task,
+)
+from urd.stream_stdout import (
+    astream_stdout,
+    stream_stdout,
+)
 
 
 def tasks(request):
@@ -35,6 +73,9 @@ def task(request, name):
         raise Http404()
 
     def run_task(**_):
+        # Under ASGI we stream from an async generator, so a long run doesn't hold a worker thread
+        if isinstance(request, ASGIRequest):
+            return astream_stdout(name)
         return StreamingHttpResponse(stream_stdout(name))
 
     return Form(
@@ -45,3 +86,153 @@ def task(request, name):
             post_handler=run_task,
         ),
     )
+
+
+def _tail_head(task_pk):
+    # The newest log of the task, and the newest chunk of any of its logs. A new run without output yet then gets a cursor after the output of the earlier runs. This is shared by all viewers for a moment, so that the number of viewers doesn't multiply the queries.
+    def head():
+        log_id = Log.objects.filter(task_id=task_pk).order_by('-pk').values_list('pk', flat=True).first()
+        if log_id is None:
+            return None, 0
+        return log_id, LogChunk.objects.filter(log__task_id=task_pk).aggregate(head=Max('pk'))['head'] or 0
+
+    return cache.get_or_set(f'urd:tail:{task_pk}', head, TAIL_CACHE_TIMEOUT)
+
+
+def _tail_lines(task_pk, log_id, after, head):
+    def lines():
+        if after is None:
+            chunks = LogChunk.objects.filter(log_id=log_id, pk__lte=head)
+        else:
+            # Can span into the next run
+            chunks = LogChunk.objects.filter(log__task_id=task_pk, pk__gt=after, pk__lte=head)
+        return [line for chunk in chunks.order_by('pk') for line in chunk.lines()]
+
+    return cache.get_or_set(f'urd:tail:{task_pk}:{after}:{head}', lines, TAIL_CACHE_TIMEOUT)
+
+
+_tail_waiters = 0
+_tail_waiters_lock = Lock()
+
+
+@contextmanager
+def _tail_wait_slot():
+    # Each waiting request holds a worker thread, so only a few may wait at a time. The others get an empty answer right away, and poll again.
+    global _tail_waiters
+    with _tail_waiters_lock:
+        acquired = _tail_waiters < getattr(settings, 'URD_TAIL_MAX_WAITERS', TAIL_MAX_WAITERS)
+        if acquired:
+            _tail_waiters += 1
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with _tail_waiters_lock:
+                _tail_waiters -= 1
+
+
+def tail(request, task_pk):
+    # Output of the current run of a task. Pass the returned cursor as `after` to get the lines after it. If there are none yet, we wait for up to `timeout` seconds.
+    if not request.user.is_superuser:
+        raise Http404()
+
+    try:
+        after = int(request.GET['after']) if 'after' in request.GET else None
+        timeout = min(float(request.GET.get('timeout', TAIL_TIMEOUT)), TAIL_TIMEOUT)
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    deadline = monotonic() + timeout
+    log_id, head = _tail_head(task_pk)
+    if after is not None and head <= after and timeout > 0:
+        with _tail_wait_slot() as may_wait:
+            while may_wait and head <= after and monotonic() < deadline:
+                sleep(TAIL_POLL_INTERVAL)
+                log_id, head = _tail_head(task_pk)
+
+    if log_id is None or (after is not None and head <= after):
+        return JsonResponse(dict(log=log_id, cursor=after or head, lines=[]))
+
+    return JsonResponse(dict(log=log_id, cursor=head, lines=_tail_lines(task_pk, log_id, after, head)))
+
+
+def _metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _quantile(sorted_values, q):
+    # Nearest rank
+    return sorted_values[max(math.ceil(q * len(sorted_values)) - 1, 0)]
+
+
+def metrics(request):
+    # Prometheus text format. Either a superuser, or a scraper with the URD_METRICS_TOKEN as a bearer token.
+    token = getattr(settings, 'URD_METRICS_TOKEN', None)
+    if not request.user.is_superuser and not (token and request.headers.get('Authorization') == f'Bearer {token}'):
+        raise Http404()
+
+    last_log_ids = Log.objects.filter(duration__isnull=False).values('task_id').annotate(last=Max('pk')).values('last')
+    last_log_by_task_id = {log.task_id: log for log in Log.objects.filter(pk__in=last_log_ids)}
+    # The last METRICS_LAG_RUNS lags of every task in one query. The subquery uses the (task_id, id) index.
+    lag_cutoff = Log.objects.filter(task_id=OuterRef('task_id'), lag__isnull=False).order_by('-pk').values('pk')[METRICS_LAG_RUNS - 1:METRICS_LAG_RUNS]
+    recent_lags = (
+        Log.objects.filter(lag__isnull=False)
+        .alias(cutoff=Subquery(lag_cutoff))
+        .filter(Q(cutoff__isnull=True) | Q(pk__gte=F('cutoff')))
+        .values_list('task_id', 'lag')
+    )
+    lags_by_task_id = defaultdict(list)
+    for task_id, lag in recent_lags:
+        lags_by_task_id[task_id].append(lag.total_seconds())
+    now = timezone.now()
+
+    definitions = {
+        'urd_task_disabled': ('gauge', 'Whether the task is disabled'),
+        'urd_task_interval_seconds': ('gauge', 'Configured interval of the task'),
+        'urd_task_behind_seconds': ('gauge', 'How far the next execution time of the task is in the past'),
+        'urd_task_last_run_timestamp_seconds': ('gauge', 'Start of the last finished run'),
+        'urd_task_last_duration_seconds': ('gauge', 'Duration of the last finished run'),
+        'urd_task_last_lag_seconds': ('gauge', 'Actual start minus scheduled start of the last finished run'),
+        'urd_task_last_missed_slots': ('gauge', 'Execution slots missed before the last finished run'),
+        'urd_task_last_heartbeats': ('gauge', 'Heartbeats during the last finished run'),
+        'urd_task_last_exit': ('gauge', 'Exit reason of the last finished run'),
+        'urd_task_recent_lag_seconds': ('gauge', f'Quantiles of the start lag over the last {METRICS_LAG_RUNS} runs'),
+        'urd_task_last_cpu_seconds': ('gauge', 'CPU time of the last finished run'),
+        'urd_task_last_max_rss_bytes': ('gauge', 'Peak RSS of the worker during the last finished run'),
+    }
+    samples = {name: [] for name in definitions}
+
+    for task in Task.objects.order_by('pk'):
+        labels = f'task="{_metric_label(task.name)}",id="{task.pk}"'
+        samples['urd_task_disabled'].append((labels, int(task.disabled)))
+        samples['urd_task_interval_seconds'].append((labels, task.interval.total_seconds()))
+        behind = (now - task.next_execution_time).total_seconds() if task.next_execution_time else 0
+        samples['urd_task_behind_seconds'].append((labels, max(behind, 0)))
+
+        lags = sorted(lags_by_task_id[task.pk])
+        if lags:
+            for q in ['0.5', '0.9', '0.99', '1']:
+                samples['urd_task_recent_lag_seconds'].append((f'{labels},quantile="{q}"', _quantile(lags, float(q))))
+
+        log = last_log_by_task_id.get(task.pk)
+        if log is None:
+            continue
+        samples['urd_task_last_run_timestamp_seconds'].append((labels, log.execution_time.timestamp()))
+        samples['urd_task_last_duration_seconds'].append((labels, log.duration.total_seconds()))
+        if log.lag is not None:
+            samples['urd_task_last_lag_seconds'].append((labels, log.lag.total_seconds()))
+        samples['urd_task_last_missed_slots'].append((labels, log.missed_slots))
+        samples['urd_task_last_heartbeats'].append((labels, log.heartbeat_count))
+        samples['urd_task_last_exit'].append((f'{labels},reason="{_metric_label(log.exit_reason)}"', 1))
+        if log.usage:
+            samples['urd_task_last_cpu_seconds'].append((f'{labels},mode="user"', log.usage['cpu_user']))
+            samples['urd_task_last_cpu_seconds'].append((f'{labels},mode="system"', log.usage['cpu_system']))
+            samples['urd_task_last_max_rss_bytes'].append((labels, log.usage['max_rss']))
+
+    lines = []
+    for name, (metric_type, help_text) in definitions.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        lines.extend(f'{name}{{{labels}}} {value}' for labels, value in samples[name])
+
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
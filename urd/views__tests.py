@@ -1,12 +1,31 @@
+import asyncio
+import json
+from datetime import timedelta
+from time import monotonic
+from uuid import uuid4
+
 import pytest
+from django.core.cache import cache
+from django.db import connection
 from django.http import Http404
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from iommi import render_if_needed
 
 from tests.helpers import (
     req,
     staff_req,
 )
+from urd import METRICS_LAG_RUNS
+from urd.models import (
+    Log,
+    LogChunk,
+    Task,
+)
+from urd.stream_stdout import astream_stdout
 from urd.views import (
+    metrics,
+    tail,
     task,
     tasks,
 )
@@ -30,3 +49,106 @@ def test_run_view():
     response = render_if_needed(request=request, response=task(request=request, name='tests.tasks.test_task'))
     result = b''.join([x for x in response.streaming_content]).decode()
     assert result == '<style>html { white-space: pre-wrap; } </style>test task line 1\ntest task line 2\n'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_stream_stdout_async():
+    async def collect(response):
+        return b''.join([x async for x in response.streaming_content]).decode()
+
+    response = astream_stdout('tests.tasks.test_task')
+    assert response.is_async
+    assert asyncio.run(collect(response)) == '<style>html { white-space: pre-wrap; } </style>test task line 1\ntest task line 2\n'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_metrics(settings):
+    task = Task.objects.create(name='My "task"', interval=timedelta(seconds=5), next_execution_time=timezone.now() - timedelta(minutes=1))
+    Log.objects.create(task=task, execution_time=timezone.now(), run_id=uuid4(), duration=timedelta(seconds=2), lag=timedelta(seconds=0.5), exit_reason='ok', usage=dict(cpu_user=1.5, cpu_system=0.5, max_rss=1024))
+    Log.objects.create(task=task, execution_time=timezone.now(), run_id=uuid4())
+
+    with pytest.raises(Http404):
+        metrics(request=req('get'))
+
+    settings.URD_METRICS_TOKEN = 'secret'
+    request = req('get', HTTP_AUTHORIZATION='Bearer secret')
+    request.META['HTTP_AUTHORIZATION'] = 'Bearer secret'
+    content = metrics(request=request).content.decode()
+    labels = f'task="My \\"task\\"",id="{task.pk}"'
+    assert f'urd_task_interval_seconds{{{labels}}} 5.0' in content
+    assert f'urd_task_last_duration_seconds{{{labels}}} 2.0' in content
+    assert f'urd_task_last_lag_seconds{{{labels}}} 0.5' in content
+    assert f'urd_task_recent_lag_seconds{{{labels},quantile="0.99"}} 0.5' in content
+    assert f'urd_task_last_exit{{{labels},reason="ok"}} 1' in content
+    assert f'urd_task_last_cpu_seconds{{{labels},mode="user"}} 1.5' in content
+    assert f'urd_task_last_max_rss_bytes{{{labels}}} 1024' in content
+    assert 'urd_task_behind_seconds{' + labels + '} 6' in content
+
+    # The number of queries doesn't depend on the number of tasks
+    for i in range(METRICS_LAG_RUNS + 5):
+        Log.objects.create(task=task, execution_time=timezone.now(), run_id=uuid4(), lag=timedelta(seconds=i))
+    other = Task.objects.create(name='other', interval=timedelta(seconds=5))
+    Log.objects.create(task=other, execution_time=timezone.now(), run_id=uuid4(), lag=timedelta(seconds=3))
+    with CaptureQueriesContext(connection) as queries:
+        content = metrics(request=request).content.decode()
+    assert len(queries) == 3
+    # Only the last runs count
+    assert f'urd_task_recent_lag_seconds{{{labels},quantile="0.5"}} 14.0' in content
+    assert f'urd_task_recent_lag_seconds{{{labels},quantile="1"}} 24.0' in content
+    assert f'urd_task_recent_lag_seconds{{task="other",id="{other.pk}",quantile="1"}} 3.0' in content
+
+
+@pytest.mark.django_db
+def test_tail():
+    cache.clear()
+    t = Task.objects.create(name='tail', interval=timedelta(seconds=5))
+    old = Log.objects.create(task=t, execution_time=timezone.now(), run_id=uuid4())
+    LogChunk.objects.create(log=old, line_count=1, data=LogChunk.pack(['old run']))
+    log = Log.objects.create(task=t, execution_time=timezone.now(), run_id=uuid4())
+    LogChunk.objects.create(log=log, line_count=2, data=LogChunk.pack(['line 1', 'line 2']))
+
+    def get(**params):
+        return json.loads(tail(request=staff_req('get', **params), task_pk=t.pk).content)
+
+    with pytest.raises(Http404):
+        tail(request=req('get'), task_pk=t.pk)
+
+    result = get()
+    assert result['log'] == log.pk
+    assert result['lines'] == ['line 1', 'line 2']
+
+    # Other viewers get the same answer from the cache
+    with CaptureQueriesContext(connection) as queries:
+        assert get() == result
+    assert len(queries) == 0
+
+    cursor = result['cursor']
+    assert get(after=cursor, timeout=0) == dict(log=log.pk, cursor=cursor, lines=[])
+
+    new_log = Log.objects.create(task=t, execution_time=timezone.now(), run_id=uuid4())
+    LogChunk.objects.create(log=log, line_count=1, data=LogChunk.pack(['line 3']))
+    LogChunk.objects.create(log=new_log, line_count=1, data=LogChunk.pack(['next run']))
+    cache.clear()
+    result = get(after=cursor, timeout=0)
+    assert result['log'] == new_log.pk
+    assert result['lines'] == ['line 3', 'next run']
+
+    # A new run without output yet doesn't replay the earlier runs
+    newest_log = Log.objects.create(task=t, execution_time=timezone.now(), run_id=uuid4())
+    cache.clear()
+    result = get()
+    assert result == dict(log=newest_log.pk, cursor=result['cursor'], lines=[])
+    LogChunk.objects.create(log=newest_log, line_count=1, data=LogChunk.pack(['newest run']))
+    cache.clear()
+    assert get(after=result['cursor'], timeout=0)['lines'] == ['newest run']
+
+
+@pytest.mark.django_db
+def test_tail_only_lets_a_few_requests_wait(settings):
+    settings.URD_TAIL_MAX_WAITERS = 0
+    cache.clear()
+    t = Task.objects.create(name='tail', interval=timedelta(seconds=5))
+    start = monotonic()
+    result = json.loads(tail(request=staff_req('get', after=0, timeout=5), task_pk=t.pk).content)
+    assert result == dict(log=None, cursor=0, lines=[])
+    assert monotonic() - start < 1
@@ -1,28 +1,86 @@
-import sys
+import os
+import random
+import resource
+import signal
 import sys
 import traceback
 from logging import getLogger
-from time import sleep
+from threading import (
+    current_thread,
+    local,
+    Lock,
+    main_thread,
+    RLock,
+    Thread,
+)
+from datetime import timedelta
+from time import (
+    monotonic,
+    sleep,
+)
 from uuid import uuid4
 
+from django.conf import settings
 from django.db import connections
 from django.db import close_old_connections
 from django.utils import timezone
 from setproctitle import setproctitle
 
 from urd import (
+    FunctionNotFound,
     get_env,
     INTERVAL_WARNING_THRESHOLD,
-    KEEP_LOGS,
+    LOG_BUFFER_AGE,
+    LOG_BUFFER_LINES,
+    LOG_BUFFER_SIZE,
+    PRECISE_SCHEDULING_WINDOW,
+    RETRY_BACKOFF,
+    RETRY_BACKOFF_MAX,
+    RETRY_CHECK_INTERVAL,
     SHUTDOWN_EXIT_CODE,
+    SHUTDOWN_TIMEOUT,
     SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE,
     ShuttingDown,
+    WORKER_CHECK_INTERVAL,
+    WORKER_KEEP_ALIVE,
+)
+from urd.control import (
+    TaskControl,
+    WorkerControl,
+)
+from urd.models import (
+    Log,
+    LogChunk,
+    Task,
 )
-from urd.models import Task
 
 log = getLogger(__name__)
 
 
+# In a thread worker, several tasks print at the same time. sys.stdout is replaced by this, so that each thread writes to its own Logger.
+class ThreadLocalStdout:
+    def __init__(self, default):
+        self.default = default
+        self.local = local()
+
+    @property
+    def target(self):
+        return getattr(self.local, 'target', None) or self.default
+
+    @target.setter
+    def target(self, value):
+        self.local.target = value
+
+    def write(self, value):
+        return self.target.write(value)
+
+    def flush(self):
+        self.target.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
 # NOTE: The raw sql to a different cursor is to make sure that we can log even though the worker task has a transaction
 
 class Logger:
@@ -30,26 +88,34 @@ class Logger:
         self.log_id = None
         self.task = task
         self.current = ''
+        self.lines = []
+        self.buffered_size = 0
+        self.last_flush = monotonic()
+        self.metrics = {}
+        # Async tasks write on the loop thread while their heartbeat flushes on a worker thread
+        self.buffer_lock = RLock()
         self.connection = connections.create_connection('default')
         self.cursor = self.connection.cursor()
         self._prev_stdout = None
 
         if self.task and self.task.pk:
-            # Purge old logs
-            self.cursor.execute('SELECT id from urd_log WHERE task_id = %s ORDER BY id DESC LIMIT 1000 OFFSET %s', (self.task.pk, KEEP_LOGS-1, ))
-            ids = ",".join([str(x[0]) for x in self.cursor.fetchall()])
-            if ids:
-                self.cursor.execute(f'DELETE FROM urd_logitem WHERE log_id in ({ids})')
-                self.cursor.execute(f'DELETE FROM urd_log WHERE id in ({ids})')
-
-            self.cursor.execute('INSERT INTO urd_log (execution_time, task_id, run_id) values (%s, %s, %s) RETURNING id', (timezone.now(), self.task.pk, uuid4()))
+            self.cursor.execute(
+                'INSERT INTO urd_log (execution_time, task_id, run_id, missed_slots, heartbeat_count, retries, exit_reason) values (%s, %s, %s, 0, 0, 0, %s) RETURNING id',
+                (timezone.now(), self.task.pk, self.task.current_run_id or uuid4(), ''),
+            )
             self.log_id = self.cursor.fetchone()[0]
 
     def write(self, value):
-        self.current += value
-        if self.current.endswith('\n'):
-            self.current = self.current[:-1]
-            self.flush()
+        with self.buffer_lock:
+            self.current += value
+            if '\n' in self.current:
+                *lines, self.current = self.current.split('\n')
+                for line in lines:
+                    if line.strip():
+                        self.lines.append(line)
+                        self.buffered_size += len(line)
+                if len(self.lines) >= LOG_BUFFER_LINES or self.buffered_size >= LOG_BUFFER_SIZE or monotonic() - self.last_flush > LOG_BUFFER_AGE:
+                    self.flush()
         self._prev_stdout.write(value)
 
     def close(self):
@@ -57,21 +123,45 @@ class Logger:
         self.connection.close()
 
     def flush(self):
-        if self.task and self.task.pk:
-            for line in self.current.split('\n'):
-                if line.strip():
-                    self.cursor.execute('INSERT INTO urd_logitem (log_id, data) values (%s, %s)', (self.log_id, line))
-        self.current = ''
+        with self.buffer_lock:
+            if self.lines and self.task and self.task.pk:
+                data = LogChunk._meta.get_field('data').get_db_prep_save(LogChunk.pack(self.lines), self.connection)
+                self.cursor.execute('INSERT INTO urd_logchunk (log_id, line_count, data) values (%s, %s, %s)', (self.log_id, len(self.lines), data))
+            self.lines = []
+            self.buffered_size = 0
+            self.last_flush = monotonic()
+
+    def save_metrics(self):
+        if self.metrics and self.log_id is not None:
+            fields = [Log._meta.get_field(name) for name in self.metrics]
+            self.cursor.execute(
+                f'UPDATE urd_log SET {", ".join(f"{field.column} = %s" for field in fields)} WHERE id = %s',
+                [field.get_db_prep_save(value, self.connection) for field, value in zip(fields, self.metrics.values())] + [self.log_id],
+            )
 
     def __enter__(self):
-        self._prev_stdout = sys.stdout
-        sys.stdout = self
+        if isinstance(sys.stdout, ThreadLocalStdout):
+            self._prev_stdout = sys.stdout.target
+            sys.stdout.target = self
+        else:
+            self._prev_stdout = sys.stdout
+            sys.stdout = self
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_type:
             print(traceback.format_exc())
+        if self.current.strip():
+            self.lines.append(self.current)
+        self.current = ''
         self.flush()
-        if self._prev_stdout and sys.stdout is self:
+        if exc_type and not self.metrics.get('exit_reason'):
+            self.metrics['exit_reason'] = 'terminated' if issubclass(exc_type, SystemExit) else 'error'
+        self.save_metrics()
+        if isinstance(sys.stdout, ThreadLocalStdout):
+            if sys.stdout.target is self:
+                sys.stdout.target = self._prev_stdout
+        elif self._prev_stdout and sys.stdout is self:
             sys.stdout = self._prev_stdout
         self.close()
 
@@ -79,54 +169,280 @@ class Logger:
         return f'<Logger log_id={self.log_id} task={self.task}>'
 
 
+def _sigterm_handler(signum, frame):
+    sys.exit(SHUTDOWN_EXIT_CODE)
+
+
+def run_worker(task_pk, control_fd=None):
+    # Turn SIGTERM into an exception, so buffered output gets written to the log before we exit
+    signal.signal(signal.SIGTERM, _sigterm_handler)
+    task = Task.objects.get(pk=task_pk)
+    if control_fd is not None:
+        task.control = WorkerControl(task, control_fd)
+    try:
+        return worker(task)
+    finally:
+        task.close_lock_connection()
+
+
+def run_thread_worker(control_fd, status_fd):
+    # Runs tasks with execution_mode thread on threads of this process. The monitor sends "run <task pk>" to start one, and we report "exited <task pk> <exit code>" back when it's done.
+    signal.signal(signal.SIGTERM, _sigterm_handler)
+    setproctitle(f'{get_env()} thread worker')
+    sys.stdout = ThreadLocalStdout(sys.stdout)
+    status_lock = Lock()
+    control_by_pk = {}
+    threads = []
+
+    def report(task_pk, exit_code):
+        with status_lock:
+            try:
+                os.write(status_fd, f'exited {task_pk} {exit_code}\n'.encode())
+            except OSError:
+                # The monitor is gone
+                pass
+
+    def run(task):
+        exit_code = SHUTDOWN_EXIT_CODE
+        try:
+            exit_code = worker(task)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            task.close_lock_connection()
+            connections.close_all()
+            report(task.pk, exit_code)
+
+    try:
+        with os.fdopen(control_fd, 'r') as commands:
+            for line in commands:
+                command, task_pk, *args = line.split()
+                if command == 'run':
+                    try:
+                        task = Task.objects.get(pk=task_pk)
+                    except Task.DoesNotExist:
+                        report(task_pk, SHUTDOWN_EXIT_CODE)
+                        continue
+                    finally:
+                        close_old_connections()
+                    task.control = control_by_pk[task_pk] = TaskControl(task)
+                    thread = Thread(target=run, args=(task,), name=task.name, daemon=True)
+                    thread.start()
+                    threads = [t for t in threads if t.is_alive()] + [thread]
+                elif task_pk in control_by_pk:
+                    control_by_pk[task_pk].apply(command, args)
+    finally:
+        # The monitor is gone or told us to stop. Let the tasks shut down nicely, so their output gets written.
+        for control in control_by_pk.values():
+            control.apply('shutdown', [])
+        for thread in threads:
+            thread.join(SHUTDOWN_TIMEOUT.total_seconds())
+    return SHUTDOWN_EXIT_CODE
+
+
+def _setproctitle(title):
+    # The process title is shared by all the threads of a thread worker
+    if current_thread() is main_thread():
+        setproctitle(title)
+
+
+def resource_usage(rusage):
+    return dict(
+        cpu_user=rusage.ru_utime,
+        cpu_system=rusage.ru_stime,
+        # ru_maxrss is in kilobytes, except on macOS
+        max_rss=rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+        block_input=rusage.ru_inblock,
+        block_output=rusage.ru_oublock,
+        voluntary_switches=rusage.ru_nvcsw,
+        involuntary_switches=rusage.ru_nivcsw,
+    )
+
+
+def _current_usage():
+    # The threads of a thread worker share the process, so there we measure the thread where we can
+    who = resource.RUSAGE_SELF if current_thread() is main_thread() else getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+    return resource_usage(resource.getrusage(who))
+
+
+def _usage_delta(before, after):
+    # The peak RSS can't be attributed to a run, so that is the peak so far
+    return {key: after[key] if key == 'max_rss' else round(after[key] - before[key], 6) for key in after}
+
+
+def _peak_rss():
+    return resource_usage(resource.getrusage(resource.RUSAGE_SELF))['max_rss']
+
+
+def _recycle_reason(runs, started):
+    # Long-lived workers are replaced now and then, to bound the growth from leaks
+    max_runs = getattr(settings, 'URD_WORKER_MAX_RUNS', None)
+    if max_runs is not None and runs >= max_runs:
+        return f'{runs} runs'
+    max_age = getattr(settings, 'URD_WORKER_MAX_AGE', None)
+    if max_age is not None and monotonic() - started > max_age.total_seconds():
+        return f'older than {max_age}'
+    max_rss = getattr(settings, 'URD_WORKER_MAX_RSS', None)
+    # The memory of a thread worker is shared by all its tasks, so a thread leaving doesn't help
+    if max_rss is not None and current_thread() is main_thread() and _peak_rss() > max_rss:
+        return f'peak RSS {_peak_rss()} bytes'
+    return None
+
+
+def _sleep_until(task, deadline):
+    # Sleep until a time on the monotonic clock. Returns False if woken by a command from the monitor.
+    while (remaining := deadline - monotonic()) > 0:
+        if task.control is not None:
+            if task.control.sleep(remaining):
+                return False
+        else:
+            sleep(remaining)
+    return True
+
+
+def backoff(attempt, base, maximum):
+    # Exponential, with jitter so that tasks that fail together don't come back together
+    delay = min(base * 2 ** min(attempt, 32), maximum)
+    return delay * random.uniform(0.5, 1)
+
+
+def _execute_with_retries(task, logger):
+    attempt = 0
+    while True:
+        try:
+            return task.execute()
+        except ShuttingDown:
+            raise
+        except Exception as e:
+            if attempt >= task.max_retries:
+                raise
+            delay = backoff(attempt, getattr(settings, 'URD_RETRY_BACKOFF', RETRY_BACKOFF), getattr(settings, 'URD_RETRY_BACKOFF_MAX', RETRY_BACKOFF_MAX))
+            # The next slot is as good as a retry
+            if timezone.now() + delay >= task.next_execution_time:
+                raise
+            print('ERROR', str(e) or str(type(e)))
+            # noinspection PyTypeChecker
+            traceback.print_exc(file=sys.stdout)
+            attempt += 1
+            logger.metrics['retries'] = attempt
+            print(f'Retry {attempt} of {task.max_retries} in {delay.total_seconds():.1f}s')
+
+        # Keep the lock while waiting, and stop waiting on shutdown
+        deadline = monotonic() + delay.total_seconds()
+        while (remaining := deadline - monotonic()) > 0:
+            _sleep_until(task, monotonic() + min(remaining, RETRY_CHECK_INTERVAL))
+            task.check_control()
+            task.check_lock()
+
+
+def _close_connections(task):
+    close_old_connections()
+    task.close_lock_connection()
+
+
 def worker(task: Task):
     env = get_env()
+    keep_alive = getattr(settings, 'URD_WORKER_KEEP_ALIVE', WORKER_KEEP_ALIVE)
+    precise = getattr(settings, 'URD_PRECISE_SCHEDULING', False)
+    check_interval = getattr(settings, 'URD_WORKER_CHECK_INTERVAL', WORKER_CHECK_INTERVAL)
+    started = monotonic()
+    runs = 0
 
-    setproctitle(f'{env} worker: {task.name}')
+    _setproctitle(f'{env} worker: {task.name}')
     task.refresh_from_db()
 
     task.wait_for_previous_shutdown()
-    task.start()
+    try:
+        task.start()
+    except ShuttingDown as e:
+        print(str(e))
+        _close_connections(task)
+        return SHUTDOWN_EXIT_CODE
 
     while True:
-        task.last_checked = timezone.now()
-        task.save(update_fields=['last_checked'])
-
         try:
-            task.heartbeat()
+            task.check_control()
+            task.check_lock()
         except ShuttingDown:
             return SHUTDOWN_EXIT_CODE
 
         time_to_next_execution = task.time_to_next_execution()
+        if task.control is not None and task.control.release and time_to_next_execution.total_seconds() > 0:
+            _close_connections(task)
+            return SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
+        slot = None
+        if precise and timedelta() < time_to_next_execution <= timedelta(seconds=PRECISE_SCHEDULING_WINDOW):
+            # The lock was just checked. Wait for the slot on the monotonic clock, so wall clock steps don't matter, and start right away with a warm connection.
+            if not _sleep_until(task, monotonic() + time_to_next_execution.total_seconds()):
+                continue
+            slot = task.next_execution_time
+            time_to_next_execution = timedelta()
+
         if time_to_next_execution.total_seconds() <= 0:
-            with Logger(task):
+            with Logger(task) as logger:
+                start = timezone.now()
+                heartbeat_count = task.heartbeat_count
+                usage = _current_usage()
 
                 # noinspection PyBroadException
                 try:
-                    count = task.calculate_number_of_execution_slots_passed()
+                    # If the wall clock is behind the monotonic clock, the slot is still due
+                    count = task.calculate_number_of_execution_slots_passed(now=max(start, slot) if slot is not None else None)
                     assert count > 0
+                    logger.metrics['missed_slots'] = count - 1
+                    logger.metrics['lag'] = start - (task.next_execution_time - task.interval)
                     if count != 1 and task.interval > INTERVAL_WARNING_THRESHOLD:
                         print('WARNING', f'Missed {count - 1} execution windows')
 
-                    setproctitle(f'{env} worker: {task.name}. Executing since {timezone.now()}')
-                    task.execute()
-                    setproctitle(f'{env} worker: {task.name}')
+                    _setproctitle(f'{env} worker: {task.name}. Executing since {timezone.now()}')
+                    _execute_with_retries(task, logger)
+                    _setproctitle(f'{env} worker: {task.name}')
+                    logger.metrics['exit_reason'] = 'ok'
+                except FunctionNotFound:
+                    logger.metrics['exit_reason'] = 'error'
+                    return SHUTDOWN_EXIT_CODE
                 except ShuttingDown:
+                    logger.metrics['exit_reason'] = 'shutdown'
                     return SHUTDOWN_EXIT_CODE
                 except Exception as e:
+                    logger.metrics['exit_reason'] = 'error'
                     msg = str(e) or str(type(e))
                     print('ERROR', msg)
                     # noinspection PyTypeChecker
                     traceback.print_exc(file=sys.stdout)
-                    sys.stdout = sys.__stdout__
+                    if sys.stdout is logger:
+                        sys.stdout = sys.__stdout__
                     log.exception('Scheduler worker crashed')
                     return SHUTDOWN_EXIT_CODE
+                finally:
+                    logger.metrics['duration'] = timezone.now() - start
+                    logger.metrics['heartbeat_count'] = task.heartbeat_count - heartbeat_count
+                    logger.metrics['usage'] = _usage_delta(usage, _current_usage())
+
+            runs += 1
+            recycle_reason = _recycle_reason(runs, started)
+            if recycle_reason is not None:
+                print('Recycling worker for', task.name, f'({recycle_reason})')
+                _close_connections(task)
+                return SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
+            time_to_next_execution = task.time_to_next_execution()
 
-        if time_to_next_execution.total_seconds() > 20:
-            close_old_connections()
+        # Don't hold on to a process for a long wait. The monitor starts a new worker in time for the next execution.
+        if time_to_next_execution > keep_alive:
+            _close_connections(task)
             return SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
 
-        to_sleep = (task.next_execution_time - timezone.now()).total_seconds()
+        to_sleep = time_to_next_execution.total_seconds()
+        if precise:
+            if to_sleep <= PRECISE_SCHEDULING_WINDOW:
+                # Check the lock before waiting for the slot, not after
+                continue
+            to_sleep -= PRECISE_SCHEDULING_WINDOW
         if to_sleep > 0:
-            close_old_connections()
-            sleep(to_sleep)
+            _close_connections(task)
+            if task.control is not None and not task.control.closed:
+                # Shutdowns and interval changes are pushed to us, so the database is only checked before the next run
+                task.control.sleep(to_sleep)
+            else:
+                # Wake up regularly to renew the lock and see shutdown commands in the database
+                sleep(min(to_sleep, check_interval))
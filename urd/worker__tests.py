@@ -1,10 +1,21 @@
+import asyncio
 import os
+import sys
 from datetime import timedelta
+from socket import gethostname
+from threading import (
+    Barrier,
+    Event,
+    Thread,
+)
+from time import sleep as real_sleep
 from unittest import mock
 from uuid import uuid4
 
 import pytest
 import time_machine
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.utils.timezone import now
 
@@ -17,9 +28,15 @@ from urd import (
 )
 from urd.models import (
     Log,
+    LogChunk,
     Task,
 )
-from urd.worker import worker
+from urd.retention import sweep_logs
+from urd.worker import (
+    Logger,
+    ThreadLocalStdout,
+    worker,
+)
 
 pytestmark = pytest.mark.django_db(transaction=True)
 
@@ -69,13 +86,20 @@ def test_basic():
 
     assert worker(task) == SHUTDOWN_EXIT_CODE
 
+    sweep_logs()
     assert Log.objects.filter(task=task).count() == KEEP_LOGS
 
     # Make sure tasks only clean up their own logs
     assert old_count == Log.objects.exclude(task=task).count()
 
     for i, log in enumerate(task.logs.all(), start=counter - KEEP_LOGS):
-        assert [x.data for x in log.items.all()] == [f'should show up in log {i}']
+        assert list(log.lines()) == [f'should show up in log {i}']
+
+    *ok_logs, last_log = task.logs.all()
+    assert {log.exit_reason for log in ok_logs} == {'ok'}
+    assert last_log.exit_reason == 'shutdown'
+    assert all(log.duration is not None and log.lag is not None and log.heartbeat_count == 1 for log in task.logs.all())
+    assert all(log.usage['cpu_user'] >= 0 and log.usage['max_rss'] > 0 for log in task.logs.all())
 
 
 def function_to_run_crash(heartbeat):
@@ -94,8 +118,9 @@ def test_worker_crash():
     assert worker(task) == SHUTDOWN_EXIT_CODE
 
     assert Log.objects.count() == 1
+    assert task.logs.get().exit_reason == 'error'
 
-    logs = [x.data for x in task.logs.get().items.all()]
+    logs = list(task.logs.get().lines())
     assert logs[:2] == [
         'should show up in log',
         'ERROR exception',
@@ -104,6 +129,83 @@ def test_worker_crash():
     assert "    raise Exception('exception')" in logs
 
 
+def function_to_run_flaky(heartbeat):
+    global counter
+    heartbeat()
+    counter += 1
+    if counter < 3:
+        raise Exception(f'attempt {counter} failed')
+    print('attempt', counter, 'worked')
+
+
+def test_worker_retries_failed_runs_with_backoff(settings):
+    global counter
+    counter = 0
+    settings.URD_RETRY_BACKOFF = timedelta(milliseconds=1)
+    task = Task.objects.create(
+        name='test',
+        function='urd.worker__tests.function_to_run_flaky',
+        interval=timedelta(days=1),
+        max_retries=3,
+    )
+
+    assert worker(task) == urd.SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
+
+    log = task.logs.get()
+    assert (log.exit_reason, log.retries) == ('ok', 2)
+    lines = list(log.lines())
+    assert [line for line in lines if line.startswith(('ERROR', 'Retry', 'attempt'))] == [
+        'ERROR attempt 1 failed',
+        'Retry 1 of 3 in 0.0s',
+        'ERROR attempt 2 failed',
+        'Retry 2 of 3 in 0.0s',
+        'attempt 3 worked',
+    ]
+
+
+def test_worker_does_not_retry_past_the_next_slot(settings):
+    settings.URD_RETRY_BACKOFF = timedelta(seconds=1)
+    task = Task.objects.create(
+        name='test',
+        function='urd.worker__tests.function_to_run_crash',
+        interval=timedelta(seconds=0.5),
+        max_retries=3,
+    )
+
+    assert worker(task) == SHUTDOWN_EXIT_CODE
+    assert (task.logs.get().exit_reason, task.logs.get().retries) == ('error', 0)
+
+
+async def function_to_run_async(heartbeat):
+    global counter
+    counter += 1
+
+    async def fetch(i):
+        await heartbeat()
+        await asyncio.sleep(0)
+        return i
+
+    print('async', sum(await asyncio.gather(*[fetch(i) for i in range(3)])))
+    if counter == 2:
+        raise ShuttingDown()
+
+
+def test_async_task():
+    global counter
+    counter = 0
+
+    task = Task.objects.create(
+        name='test',
+        function='urd.worker__tests.function_to_run_async',
+        interval=timedelta(seconds=0.001),
+    )
+
+    assert worker(task) == SHUTDOWN_EXIT_CODE
+
+    assert [list(log.lines()) for log in task.logs.all()] == [['async 3'], ['async 3']]
+    assert [(log.exit_reason, log.heartbeat_count) for log in task.logs.all()] == [('ok', 3), ('shutdown', 3)]
+
+
 def test_calculate_next_execution_time():
     with time_machine.travel('2001-01-01 01:02:03', tick=False) as traveller:
         t = Task.objects.create(
@@ -145,6 +247,7 @@ def test_shut_down_command():
         t = Task.objects.create(
             function='urd.worker__tests.function_to_run_basic',
             pid=os.getpid(),
+            host=gethostname(),
             shutdown_command=timezone.now(),
             interval=timedelta(seconds=1),
         )
@@ -167,7 +270,24 @@ def test_wait_for_previous_shutdown_timeout(capsys):
     assert capsys.readouterr().out == 'Shutdown timeout hit\n'
 
 
-def test_worker_shuts_down_if_long_time_to_next_slot():
+def test_only_one_worker_gets_the_lock():
+    t = Task.objects.create(interval=timedelta(days=1), pid=123, host='other host')
+    with pytest.raises(ShuttingDown) as e:
+        t.start()
+    assert str(e.value) == 'Locked by another worker'
+    assert Task.objects.get(pk=t.pk).pid == 123
+
+    # The other worker is asked to shut down, and its lock is stale when it doesn't
+    with mock.patch('urd.models.SHUTDOWN_TIMEOUT', timedelta(seconds=0.1)):
+        t.wait_for_previous_shutdown()
+        assert t.shutdown_command is not None
+        t.start()
+    t.refresh_from_db()
+    assert (t.pid, t.host, t.shutdown_command) == (os.getpid(), gethostname(), None)
+
+
+def test_worker_shuts_down_if_long_time_to_next_slot(settings):
+    settings.URD_WORKER_KEEP_ALIVE = timedelta(seconds=20)
     t = Task.objects.create(
         next_execution_time=timezone.now() + timedelta(seconds=40),
         interval=timedelta(days=1),
@@ -177,7 +297,8 @@ def test_worker_shuts_down_if_long_time_to_next_slot():
     assert worker(t) == urd.SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
 
 
-def test_worker_closes_connections_before_idle_exit():
+def test_worker_closes_connections_before_idle_exit(settings):
+    settings.URD_WORKER_KEEP_ALIVE = timedelta(seconds=20)
     t = Task.objects.create(
         next_execution_time=timezone.now() + timedelta(seconds=40),
         interval=timedelta(days=1),
@@ -189,6 +310,87 @@ def test_worker_closes_connections_before_idle_exit():
         assert mock_close.call_count >= 1
 
 
+def function_to_count_runs(heartbeat):
+    global counter
+    counter += 1
+
+
+def test_worker_is_recycled_after_max_runs(settings):
+    global counter
+    counter = 0
+    settings.URD_WORKER_MAX_RUNS = 3
+    t = Task.objects.create(
+        name='test',
+        function='urd.worker__tests.function_to_count_runs',
+        interval=timedelta(seconds=0.001),
+    )
+    assert worker(t) == urd.SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
+    assert counter == 3
+    assert t.logs.count() == 3
+
+
+def test_worker_is_recycled_when_using_too_much_memory(settings):
+    settings.URD_WORKER_MAX_RSS = 1
+    t = Task.objects.create(
+        name='test',
+        function='urd.worker__tests.function_to_count_runs',
+        interval=timedelta(seconds=0.001),
+    )
+    assert worker(t) == urd.SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
+    assert t.logs.count() == 1
+
+
+def test_worker_keeps_renewing_the_lock_while_sleeping(settings):
+    settings.URD_WORKER_MAX_RUNS = 1
+    t = Task.objects.create(
+        name='test',
+        function='urd.worker__tests.function_to_count_runs',
+        interval=timedelta(minutes=1),
+        next_execution_time=timezone.now() + timedelta(seconds=12),
+    )
+    with time_machine.travel(timezone.now().timestamp(), tick=False) as traveller:
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            traveller.shift(timedelta(seconds=seconds))
+
+        with mock.patch('urd.worker.sleep', new=fake_sleep), \
+             mock.patch.object(Task, 'check_lock', autospec=True, side_effect=Task.check_lock) as check_lock:
+            assert worker(t) == urd.SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
+
+    assert sleeps[:2] == [urd.WORKER_CHECK_INTERVAL, urd.WORKER_CHECK_INTERVAL]
+    assert check_lock.call_count == len(sleeps) + 1
+
+
+def test_precise_scheduling_waits_on_the_monotonic_clock(settings):
+    global counter
+    counter = 0
+    settings.URD_PRECISE_SCHEDULING = True
+    settings.URD_WORKER_MAX_RUNS = 1
+    slot = timezone.now() + timedelta(seconds=0.2)
+    t = Task.objects.create(
+        name='test',
+        function='urd.worker__tests.function_to_count_runs',
+        interval=timedelta(seconds=1),
+        next_execution_time=slot,
+    )
+    with time_machine.travel(timezone.now().timestamp(), tick=True) as traveller:
+        def sleep_with_clock_step(seconds):
+            # The wall clock is stepped back while we wait for the slot
+            traveller.shift(timedelta(seconds=-1))
+            real_sleep(seconds)
+
+        with mock.patch('urd.worker.sleep', new=sleep_with_clock_step):
+            assert worker(t) == urd.SHUTDOWN_WAIT_FOR_NEXT_EXECUTION_EXIT_CODE
+
+    assert counter == 1
+    log = t.logs.get()
+    assert log.missed_slots == 0
+    assert log.lag < timedelta(seconds=-0.5)
+    assert Task.objects.get(pk=t.pk).next_execution_time == slot + timedelta(seconds=1)
+
+
 def function_that_shuts_down(heartbeat):
     heartbeat()
     raise ShuttingDown()
@@ -217,6 +419,7 @@ def test_decorator_1():
         function='urd.worker__tests.worker_with_use_transaction_false',
         interval=timedelta(days=1),
         pid=os.getpid(),
+        host=gethostname(),
     )
     assert t.execute() == 'done'
 
@@ -231,5 +434,156 @@ def test_decorator_2():
         function='urd.worker__tests.worker_with_use_transaction_false',
         interval=timedelta(days=1),
         pid=os.getpid(),
+        host=gethostname(),
     )
     assert t.execute() == 'done'
+
+
+def test_check_lock_is_a_single_update():
+    t = Task.objects.create(
+        function='urd.worker__tests.function_to_run_basic',
+        pid=os.getpid(),
+        host=gethostname(),
+        interval=timedelta(seconds=1),
+    )
+    # On a connection of its own, so it's committed even if the task runs in a transaction
+    with CaptureQueriesContext(connection) as queries, CaptureQueriesContext(t.lock_connection()) as lock_queries:
+        t.check_lock()
+    assert len(queries) == 0
+    assert len(lock_queries) == 1
+    assert Task.objects.get(pk=t.pk).last_checked == t.last_checked
+
+
+def test_check_lock_picks_up_interval_change():
+    next_execution_time = timezone.now() + timedelta(minutes=1)
+    t = Task.objects.create(
+        function='urd.worker__tests.function_to_run_basic',
+        pid=os.getpid(),
+        host=gethostname(),
+        interval=timedelta(seconds=1),
+    )
+    Task.objects.filter(pk=t.pk).update(interval=timedelta(seconds=3), next_execution_time=next_execution_time)
+    t.check_lock()
+    assert t.interval == timedelta(seconds=3)
+    assert t.next_execution_time == next_execution_time
+
+
+def function_to_run_chatty(heartbeat):
+    for i in range(2500):
+        print('line', i)
+    print('no newline at the end', end='')
+    raise ShuttingDown()
+
+
+def test_logger_batches_output():
+    task = Task.objects.create(
+        name='test',
+        function='urd.worker__tests.function_to_run_chatty',
+        interval=timedelta(seconds=0.001),
+    )
+
+    with mock.patch('urd.worker.LOG_BUFFER_AGE', 9999):
+        assert worker(task) == SHUTDOWN_EXIT_CODE
+
+    log = task.logs.get()
+    assert list(log.lines()) == [f'line {i}' for i in range(2500)] + ['no newline at the end']
+    assert [x.line_count for x in log.chunks.all()] == [1000, 1000, 501]
+
+
+def test_logger_flush_from_another_thread_keeps_every_line():
+    # Async tasks write on the loop thread while their heartbeat flushes on a worker thread
+    task = Task.objects.create(name='test', function='test', interval=timedelta(seconds=1))
+    done = Event()
+    pack = LogChunk.pack
+
+    def slow_pack(lines):
+        data = pack(lines)
+        # Let the other thread run while a flush is in progress
+        real_sleep(0.001)
+        return data
+
+    with mock.patch.object(LogChunk, 'pack', new=slow_pack), Logger(task) as logger:
+        def flush():
+            while not done.is_set():
+                logger.flush()
+
+        thread = Thread(target=flush)
+        thread.start()
+        try:
+            for i in range(2000):
+                print('line', i)
+        finally:
+            done.set()
+            thread.join()
+
+    assert list(task.logs.get().lines()) == [f'line {i}' for i in range(2000)]
+
+
+def test_calculate_number_of_execution_slots_passed_is_constant_time():
+    with time_machine.travel('2001-01-01 01:02:03', tick=False):
+        t = Task.objects.create(
+            next_execution_time=timezone.now() - timedelta(hours=1),
+            interval=timedelta(milliseconds=1),
+        )
+        assert t.calculate_number_of_execution_slots_passed() == 3600 * 1000 + 1
+        assert t.time_to_next_execution() == timedelta(milliseconds=1)
+
+
+def test_phase_moves_slots_to_the_offset_within_the_interval():
+    with time_machine.travel('2001-01-01 01:02:03', tick=False) as traveller:
+        t = Task.objects.create(
+            next_execution_time=timezone.now(),
+            interval=timedelta(minutes=1),
+            phase=timedelta(seconds=15),
+        )
+        assert t.calculate_number_of_execution_slots_passed() == 1
+        # Snapped forward from 01:03:03 to the next slot at 15 seconds past the minute
+        assert t.next_execution_time.second == 15
+        assert t.time_to_next_execution() == timedelta(seconds=72)
+
+        traveller.shift(timedelta(minutes=5))
+        assert t.calculate_number_of_execution_slots_passed() == 4
+        assert t.next_execution_time.second == 15
+
+
+def test_stagger_spreads_tasks_over_the_interval(settings):
+    settings.URD_STAGGER = True
+    with time_machine.travel('2001-01-01 01:02:03', tick=False):
+        tasks = [Task.objects.create(name=f'test {i}', function='unrelated', interval=timedelta(minutes=1)) for i in range(20)]
+        for t in tasks:
+            t.start()
+
+        offsets = sorted(t.time_to_next_execution() for t in tasks)
+        assert len(set(offsets)) == 20
+        assert offsets[0] >= timedelta() and offsets[-1] < timedelta(minutes=1)
+        # No quarter of the interval gets more than half of the tasks
+        assert max(sum(1 for x in offsets if x // timedelta(seconds=15) == quarter) for quarter in range(4)) <= 10
+
+        # The same task always gets the same phase
+        assert [t.phase_offset() for t in tasks] == [Task.objects.get(pk=t.pk).phase_offset() for t in tasks]
+
+
+def test_thread_local_stdout_routes_output_to_the_logger_of_each_thread():
+    tasks = [Task.objects.create(name=name, function=name, interval=timedelta(seconds=1)) for name in 'ab']
+    barrier = Barrier(len(tasks))
+
+    def run(task):
+        with Logger(task):
+            for i in range(3):
+                print(task.name, i)
+                barrier.wait()
+
+    prev_stdout = sys.stdout
+    sys.stdout = ThreadLocalStdout(prev_stdout)
+    try:
+        threads = [Thread(target=run, args=(task,)) for task in tasks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sys.stdout.target is prev_stdout
+    finally:
+        sys.stdout = prev_stdout
+
+    for task in tasks:
+        assert list(task.logs.get().lines()) == [f'{task.name} {i}' for i in range(3)]